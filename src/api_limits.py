@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+"""
+Process-wide limits for external API calls (OpenAI, PubChem).
+
+When several input files are processed in parallel, every step still goes
+through `api_slot()`, so the number of requests in flight never exceeds the
+global budget set with `set_max_concurrency()`. PubChem requests are also
+spaced by `PUBCHEM_LIMITER`.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+_slots: Optional[threading.BoundedSemaphore] = None
+
+
+def set_max_concurrency(n: Optional[int]) -> None:
+    """
+    Cap the number of concurrent API calls. None or <= 0 disables the cap.
+    Must be called before worker threads start.
+    """
+    global _slots
+    _slots = threading.BoundedSemaphore(n) if n and n > 0 else None
+
+
+@contextmanager
+def api_slot() -> Iterator[None]:
+    slots = _slots
+    if slots is None:
+        yield
+        return
+    with slots:
+        yield
+
+
+def try_api_slot() -> Optional[Callable[[], None]]:
+    """
+    Take a slot without waiting. Returns the function that gives it back
+    (may be called from another thread), or None when every slot is busy.
+    """
+    slots = _slots
+    if slots is None:
+        return lambda: None
+    if not slots.acquire(blocking=False):
+        return None
+    return slots.release
+
+
+class RateLimiter:
+    """
+    Minimal thread-safe rate limiter: at most `rate` acquisitions per second,
+    evenly spaced (PubChem asks for <= 5 requests/s).
+    """
+
+    def __init__(self, rate: float):
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+            self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+# shared by every PubChem request of the process
+PUBCHEM_LIMITER = RateLimiter(5)
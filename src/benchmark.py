@@ -0,0 +1,729 @@
+# -*- coding: UTF-8 -*-
+"""
+Offline benchmark for the whole pipeline (no network, no API key needed).
+
+`llm._send` / `llm._send_stream`, `pcp.get_compounds` and `smiles_step.opsin`
+are replaced by replayed (recorded fixtures) or synthetic responses with
+optional latency injection, then `pipeline.main` is run on scaled-up copies of
+data/input_test.json. Each size runs in its own process so peak RSS is
+meaningful.
+
+With `--pubchem-backend batch` among the pipeline options, the batch
+PubChem backend talks to a local HTTP stand-in (PubChemStandIn) instead.
+
+`--hedge-compare P` runs every size twice, without and with LLM request
+hedging at percentile P, and compares extract-call p50 / p99. Hedges need a
+free API slot, so both runs get `--max-concurrency 2` unless the pipeline
+args set a cap.
+
+`--pubchem-compare N` skips the pipeline and resolves N names through both
+PubChem paths against the stand-in, reporting time, requests and bytes.
+
+`--cold-start N` skips the pipeline and times fresh `pipeline.py` processes
+(`--help` of every command, structure / merge re-runs), reporting which
+heavy modules (pandas, openai, ...) each one loaded.
+
+Usage:
+    python src/benchmark.py --sizes 10 100 1000 --llm-latency 0.05
+    python src/benchmark.py --sizes 100 --fixtures bench_fixtures.json --report bench_report.json
+    python src/benchmark.py --pubchem-compare 500 --pubchem-latency 0.2
+    python src/benchmark.py --sizes 300 --llm-latency 0.05 --latency-sigma 1.2 --hedge-compare 90
+    python src/benchmark.py --cold-start 5
+
+Fixture file (all sections optional, missing keys fall back to synthetic):
+    {"llm": {"<sha1 of last message>": "<content>"},
+     "pubchem": {"<name>": "<smiles or null>"},
+     "opsin": {"<name>": "<smiles or null>"}}
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SRC_DIR = Path(__file__).resolve().parent
+DEFAULT_INPUT = SRC_DIR.parent / "data" / "input_test.json"
+
+# Names the synthetic extractor draws from. Those with a SMILES resolve on
+# PubChem; the others go down the OPSIN / LLM fallback path.
+KNOWN_NAMES: Dict[str, Optional[str]] = {
+    "furfural": "C1=COC(=C1)C=O",
+    "methanol": "CO",
+    "ethanol": "CCO",
+    "acetonitrile": "CC#N",
+    "DMSO": "CS(=O)C",
+    "Et2O": "CCOCC",
+    "benzene": "C1=CC=CC=C1",
+    "sodium hydroxide": "[OH-].[Na+]",
+    "hydrochloric acid": "Cl",
+    "potassium carbonate": "C(=O)([O-])[O-].[K+].[K+]",
+    "p-phenylenediamine": "C1=CC(=CC=C1N)N",
+    "dithiooxamide": "C(=S)(C(=S)N)N",
+    "1,4-phenylenediacetonitrile": "C1=CC(=CC=C1CC#N)CC#N",
+    "tetrabutylammonium hydroxide": "CCCC[N+](CCCC)(CCCC)CCCC.[OH-]",
+    "LiTFSI": None,
+    "PBFA": None,
+    "ITO glass substrate": None,
+}
+
+
+def _sha1(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# input scaling
+# ---------------------------------------------------------------------------
+
+def scale_input(src: Path, n_procedures: int, dst: Path) -> Path:
+    """
+    Write a JSON with exactly n_procedures procedures by cycling through the
+    procedures of `src`. Each replica gets a unique key and a marker in its
+    text so prompts differ (no free LLM memo hits).
+    """
+    with src.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    base = []
+    for key, payload in data.items():
+        procs = payload.get("Procedure", [])
+        if isinstance(procs, str):
+            procs = [procs]
+        for p in procs:
+            base.append((key, payload.get("Title", ""), p))
+
+    out: Dict[str, Any] = {}
+    for i in range(n_procedures):
+        key, title, proc = base[i % len(base)]
+        out[f"{key}_r{i}"] = {"Title": title, "Procedure": [f"{proc} [replica {i}]"]}
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with dst.open("w", encoding="utf-8") as f:
+        json.dump(out, f, ensure_ascii=False)
+    return dst
+
+
+# ---------------------------------------------------------------------------
+# local PubChem PUG REST stand-in
+# ---------------------------------------------------------------------------
+
+def standin_smiles(name: str) -> Optional[str]:
+    """KNOWN_NAMES, plus any 'synthetic-<i>' name; everything else is unknown."""
+    if name in KNOWN_NAMES:
+        return KNOWN_NAMES[name]
+    m = re.fullmatch(r"synthetic-(\d+)", name)
+    if m:
+        return "C" * (1 + int(m.group(1)) % 20) + "O"
+    return None
+
+
+class PubChemStandIn:
+    """
+    Threaded HTTP server answering the three PUG REST calls the pipeline
+    makes: full compound record by name (pubchempy), name -> CIDs (TXT) and
+    bulk CID -> IsomericSMILES (JSON). Counts requests and bytes served.
+    """
+
+    def __init__(self, latency: float = 0.0, record_padding: int = 60):
+        self.latency = latency
+        self.record_padding = record_padding
+        self.requests = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+        self._cids: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "PubChemStandIn":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.bytes_out = 0
+
+    def _cid(self, name: str) -> int:
+        with self._lock:
+            if name not in self._cids:
+                cid = len(self._cids) + 1000
+                self._cids[name] = cid
+                self._names[cid] = name
+            return self._cids[name]
+
+    def _record(self, name: str, smiles: str) -> Dict[str, Any]:
+        # shaped like a PC_Compounds record; the padding props stand in for the
+        # ~50 computed properties and 2D coordinates of a real record
+        props = [
+            {"urn": {"label": "SMILES", "name": "Absolute"}, "value": {"sval": smiles}},
+            {"urn": {"label": "SMILES", "name": "Isomeric"}, "value": {"sval": smiles}},
+            {"urn": {"label": "IUPAC Name", "name": "Preferred"}, "value": {"sval": name}},
+        ]
+        props += [
+            {"urn": {"label": f"Property {i}", "name": "Computed", "datatype": 7}, "value": {"fval": i * 1.5}}
+            for i in range(self.record_padding)
+        ]
+        n = len(smiles)
+        return {"PC_Compounds": [{
+            "id": {"id": {"cid": self._cid(name)}},
+            "atoms": {"aid": list(range(1, n + 1)), "element": [6] * n},
+            "bonds": {"aid1": list(range(1, n)), "aid2": list(range(2, n + 1)), "order": [1] * (n - 1)},
+            "coords": [{"type": [1, 5, 255], "aid": list(range(1, n + 1)),
+                        "conformers": [{"x": [float(i) for i in range(n)], "y": [0.0] * n}]}],
+            "props": props,
+        }]}
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, code: int, body: bytes, ctype: str) -> None:
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with standin._lock:
+                    standin.requests += 1
+                    standin.bytes_out += len(body)
+
+            def _not_found(self) -> None:
+                fault = {"Fault": {"Code": "PUGREST.NotFound", "Message": "No CID found"}}
+                self._send(404, json.dumps(fault).encode(), "application/json")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                fields = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+                self._dispatch(fields)
+
+            def do_GET(self):
+                self._dispatch(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+
+            def _dispatch(self, fields):
+                if standin.latency > 0:
+                    time.sleep(standin.latency)
+                path = urllib.parse.urlparse(self.path).path.rstrip("/")
+                name = (fields.get("name") or [""])[0]
+                if path.endswith("/compound/name/JSON"):
+                    smi = standin_smiles(name)
+                    if not smi:
+                        return self._not_found()
+                    body = json.dumps(standin._record(name, smi)).encode()
+                    return self._send(200, body, "application/json")
+                if path.endswith("/compound/name/cids/TXT"):
+                    if not standin_smiles(name):
+                        return self._not_found()
+                    return self._send(200, f"{standin._cid(name)}\n".encode(), "text/plain")
+                if path.endswith("/compound/cid/property/IsomericSMILES/JSON"):
+                    cids = [int(c) for c in (fields.get("cid") or [""])[0].split(",") if c.strip()]
+                    rows = []
+                    for cid in cids:
+                        smi = standin_smiles(standin._names.get(cid, ""))
+                        if smi:
+                            rows.append({"CID": cid, "SMILES": smi})
+                    body = json.dumps({"PropertyTable": {"Properties": rows}}).encode()
+                    return self._send(200, body, "application/json")
+                self._send(400, b"unsupported", "text/plain")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def compare_pubchem(n_names: int, latency: float) -> Dict[str, Any]:
+    """Resolve the same names through the per-name and the batch path."""
+    sys.path.insert(0, str(SRC_DIR))
+    import pubchempy as pcp
+    import pubchem_batch
+    import smiles_step
+    from api_limits import PUBCHEM_LIMITER
+
+    PUBCHEM_LIMITER.set_rate(0)  # measure transfer, not the politeness delay
+    # ~70% resolvable names
+    names = [f"synthetic-{i}" if i % 10 < 7 else f"compound-{i}" for i in range(n_names)]
+    results: Dict[str, Any] = {"names": n_names, "latency_per_request_s": latency}
+
+    with PubChemStandIn(latency=latency) as standin:
+        pcp.API_BASE = standin.url
+        os.environ["PUBCHEM_BASE_URL"] = standin.url
+
+        smiles_step.set_pubchem_backend("compound")
+        t0 = time.perf_counter()
+        per_name = {n: smiles_step.pubchem(n) for n in names}
+        results["compound"] = {
+            "seconds": round(time.perf_counter() - t0, 4),
+            "requests": standin.requests,
+            "bytes": standin.bytes_out,
+        }
+
+        standin.reset_counters()
+        t0 = time.perf_counter()
+        batch = pubchem_batch.resolve_names(names)
+        results["batch"] = {
+            "seconds": round(time.perf_counter() - t0, 4),
+            "requests": standin.requests,
+            "bytes": standin.bytes_out,
+        }
+
+    results["same_answers"] = all(per_name[n] == batch.get(n) for n in names)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# CLI cold start
+# ---------------------------------------------------------------------------
+
+HEAVY_MODULES = ("numpy", "pandas", "openai", "pubchempy", "rdkit")
+
+# runs `pipeline.py <argv>` and reports which heavy modules it loaded
+_COLD_START_CHILD = """
+import json, sys
+sys.path.insert(0, {src!r})
+sys.argv = ["pipeline.py"] + {argv!r}
+import pipeline
+try:
+    pipeline.main()
+except SystemExit:
+    pass
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]), file=sys.stderr)
+"""
+
+
+def _time_cli(argv: List[str], repeats: int, env: Dict[str, str]) -> Dict[str, Any]:
+    code = _COLD_START_CHILD.format(src=str(SRC_DIR), argv=argv, heavy=HEAVY_MODULES)
+    times = []
+    loaded: List[str] = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+        times.append(time.perf_counter() - t0)
+        if proc.returncode != 0:
+            raise RuntimeError(f"pipeline.py {' '.join(argv)} failed:\n{proc.stderr}")
+        loaded = json.loads(proc.stderr.strip().splitlines()[-1])
+    times.sort()
+    return {"median_ms": round(1000 * times[len(times) // 2], 1), "min_ms": round(1000 * times[0], 1), "heavy_modules": loaded}
+
+
+def measure_cold_start(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Wall time of fresh `pipeline.py` processes: `--help` of every command,
+    then real structure / merge re-runs on the outputs of a small offline run.
+    """
+    sys.path.insert(0, str(SRC_DIR))
+    import pipeline
+
+    repeats = args.cold_start
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "offline-benchmark"))
+    results: Dict[str, Any] = {"repeats": repeats}
+
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - t0)
+    results["python_ms"] = round(1000 * sorted(times)[len(times) // 2], 1)
+
+    results["help"] = {
+        cmd: _time_cli(([] if cmd == "(default)" else [cmd]) + ["--help"], repeats, env)
+        for cmd in ["(default)"] + list(pipeline.COMMANDS)
+    }
+
+    with tempfile.TemporaryDirectory(prefix="pipeline_cold_") as tmp:
+        work = Path(tmp)
+        subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--child", "--size", "10",
+             "--workdir", str(work), "--result", str(work / "result.json"), "--input", str(args.input)],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        input_json = work / "bench_10.json"
+        results["run"] = {
+            step: _time_cli([step, str(input_json), "--output-dir", str(work / "outputs")], repeats, env)
+            for step in ("structure", "merge")
+        }
+    return results
+
+
+def _print_cold_start(results: Dict[str, Any]) -> None:
+    print(f"python -c pass: {results['python_ms']} ms (median of {results['repeats']})")
+    head = f"{'command':<24} {'median ms':>10} {'min ms':>8}  heavy modules loaded"
+    print(head)
+    print("-" * len(head))
+    for section, label in (("help", "{} --help"), ("run", "{} (bench_10)")):
+        for cmd, r in results[section].items():
+            print(f"{label.format(cmd):<24} {r['median_ms']:>10} {r['min_ms']:>8}  {', '.join(r['heavy_modules']) or '-'}")
+
+
+# ---------------------------------------------------------------------------
+# stubs (installed in the child process)
+# ---------------------------------------------------------------------------
+
+class _Latency:
+    def __init__(self, mean: float, sigma: float, seed: int):
+        self.mean = mean
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        if self.sigma > 0:
+            # lognormal with the requested mean
+            mu = -0.5 * self.sigma ** 2
+            return self.mean * self.rng.lognormvariate(mu, self.sigma)
+        return self.mean
+
+    def sleep(self, cancelled: Optional[threading.Event] = None) -> None:
+        delay = self.sample()
+        if delay <= 0:
+            return
+        if cancelled is None:
+            time.sleep(delay)
+        else:
+            cancelled.wait(delay)
+
+
+class _FakeClient:
+    """Stands in for the OpenAI client of a hedged call: close() aborts the request."""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+def _synthetic_extract(prompt: str, novel_rate: float) -> str:
+    rng = random.Random(_sha1(prompt))
+    pool = list(KNOWN_NAMES)
+    reactants = rng.sample(pool, 3)
+    product = f"compound-{_sha1(prompt)[:8]}" if rng.random() < novel_rate else rng.choice(pool)
+    header = "| Reactants | Reactant amounts | Products | Product amounts | Solvents | Reaction temperature | Reaction time | Yield |"
+    sep = "|-----------|-----------------|----------|-----------------|-----------|----------------------|----------------|-------|"
+    row = (
+        f"| {', '.join(reactants)} | 1.0 g (5 mmol), 2.0 g, 10 mL | {product} | 1.2 g | methanol "
+        f"| {rng.choice(['65 °C', 'reflux', 'room temperature'])} | {rng.choice(['1 h', 'overnight', '30 min'])} "
+        f"| {rng.randint(40, 95)}% |"
+    )
+    return "\n".join([header, sep, row])
+
+
+def _synthetic_times(prompt: str) -> str:
+    table = prompt.rsplit("/////", 1)[-1]
+    rows = re.findall(r"^\s*\|\s*(\d+)\s*\|.*\|\s*$", table, re.M)
+    lines = ["| Index | Reaction time |", "|-------|---------------|"]
+    lines += [f"| {i} | 60 minutes |" for i in rows]
+    return "\n".join(lines)
+
+
+def install_stubs(args: argparse.Namespace) -> None:
+    import llm
+    import pubchempy as pcp
+    import smiles_step
+
+    fixtures: Dict[str, Dict[str, Any]] = {}
+    if args.fixtures:
+        with open(args.fixtures, "r", encoding="utf-8") as f:
+            fixtures = json.load(f)
+    llm_fix = fixtures.get("llm", {})
+    pubchem_fix = fixtures.get("pubchem", {})
+    opsin_fix = fixtures.get("opsin", {})
+
+    llm_lat = _Latency(args.llm_latency, args.latency_sigma, 1)
+    pubchem_lat = _Latency(args.pubchem_latency, args.latency_sigma, 2)
+    opsin_lat = _Latency(args.opsin_latency, args.latency_sigma, 3)
+
+    def fake_send(messages, model, temperature, on_client=None):
+        client = _FakeClient()
+        if on_client is not None:
+            on_client(client)
+        llm_lat.sleep(client.closed)
+        if client.closed.is_set():
+            raise ConnectionError("request cancelled")
+        return fake_answer(messages)
+
+    def fake_answer(messages):
+        prompt = messages[-1]["content"]
+        content = llm_fix.get(_sha1(prompt))
+        if content is None:
+            if "Procedure:<'''" in prompt:
+                content = _synthetic_extract(prompt, args.novel_name_rate)
+            elif "convert them into minutes" in prompt:
+                content = _synthetic_times(prompt)
+            else:
+                content = '{"name": "none"}'
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4}
+        return content, usage
+
+    def fake_send_stream(messages, model, temperature, on_text):
+        # the injected latency is spread over the lines of the answer
+        content, usage = fake_answer(messages)
+        lines = content.splitlines(keepends=True)
+        delay = llm_lat.sample() / max(1, len(lines))
+        for line in lines:
+            if delay > 0:
+                time.sleep(delay)
+            on_text(line)
+        return content, usage
+
+    class _Compound:
+        def __init__(self, smiles):
+            self.isomeric_smiles = smiles
+
+    def fake_get_compounds(identifier, namespace="cid", *a, **kw):
+        pubchem_lat.sleep()
+        name = str(identifier)
+        smi = pubchem_fix[name] if name in pubchem_fix else KNOWN_NAMES.get(name)
+        return [_Compound(smi)] if smi else []
+
+    def fake_opsin(name):
+        opsin_lat.sleep()
+        smi = opsin_fix.get(name)
+        return smi if smi else "Not Found"
+
+    llm._send = fake_send
+    llm._send_stream = fake_send_stream
+    pcp.get_compounds = fake_get_compounds
+    smiles_step.opsin = fake_opsin
+
+
+# ---------------------------------------------------------------------------
+# child: one pipeline run
+# ---------------------------------------------------------------------------
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_child(args: argparse.Namespace) -> None:
+    sys.path.insert(0, str(SRC_DIR))
+    os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+    install_stubs(args)
+
+    import pipeline
+    from metrics import METRICS
+
+    work = Path(args.workdir)
+    input_json = scale_input(Path(args.input), args.size, work / f"bench_{args.size}.json")
+
+    argv = [
+        "pipeline.py", str(input_json),
+        "--output-dir", str(work / "outputs"),
+        "--extract-sleep", "0",
+        "--time-delay", "0",
+        # injected latency stands in for PubChem's pacing
+        "--pubchem-rate", "0",
+    ] + args.pipeline_args
+
+    standin = PubChemStandIn(latency=args.pubchem_latency)
+    old_argv = sys.argv
+    sys.argv = argv
+    # the stand-in's startup and shutdown (serve_forever poll) are not timed
+    with standin:
+        os.environ["PUBCHEM_BASE_URL"] = standin.url
+        t0 = time.perf_counter()
+        try:
+            pipeline.main()
+        finally:
+            sys.argv = old_argv
+        wall = time.perf_counter() - t0
+
+    report = METRICS.report()
+    result = {
+        "procedures": args.size,
+        "wall_seconds": round(wall, 4),
+        "throughput_proc_per_s": round(args.size / wall, 3) if wall > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+        "stages": {k: v["wall_seconds"] for k, v in report["stages"].items()},
+        "llm_latency": {
+            stage: {k: st[k] for k in ("count", "p50", "p99")}
+            for stage in ("extract", "time", "smiles")
+            for st in [METRICS.histogram_stats("llm_call_latency_seconds", stage=stage)]
+            if st
+        },
+        "extract_first_row": METRICS.histogram_stats("extract_first_row_seconds"),
+        "pubchem_standin": {"requests": standin.requests, "bytes": standin.bytes_out},
+        "metrics": report,
+    }
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+# ---------------------------------------------------------------------------
+# parent: one child per size, summary table
+# ---------------------------------------------------------------------------
+
+def _child_cmd(args: argparse.Namespace, size: int, workdir: Path, result: Path) -> List[str]:
+    cmd = [
+        sys.executable, str(Path(__file__).resolve()), "--child",
+        "--size", str(size),
+        "--workdir", str(workdir),
+        "--result", str(result),
+        "--input", str(args.input),
+        "--llm-latency", str(args.llm_latency),
+        "--pubchem-latency", str(args.pubchem_latency),
+        "--opsin-latency", str(args.opsin_latency),
+        "--latency-sigma", str(args.latency_sigma),
+        "--novel-name-rate", str(args.novel_name_rate),
+    ]
+    if args.fixtures:
+        cmd += ["--fixtures", str(Path(args.fixtures).resolve())]
+    if args.pipeline_args:
+        cmd += ["--"] + args.pipeline_args
+    return cmd
+
+
+def _print_table(results: List[Dict[str, Any]]) -> None:
+    stages = ["extract", "structure", "time", "smiles", "merge"]
+    head = f"{'procs':>8} {'wall s':>9} {'proc/s':>9} {'RSS MB':>8} " + " ".join(f"{s:>9}" for s in stages)
+    print(head)
+    print("-" * len(head))
+    for r in results:
+        cells = " ".join(f"{r['stages'].get(s, 0):>9.3f}" for s in stages)
+        rss = r["peak_rss_mb"] if r["peak_rss_mb"] is not None else "n/a"
+        print(f"{r['procedures']:>8} {r['wall_seconds']:>9.3f} {r['throughput_proc_per_s']:>9.2f} {rss:>8} {cells}")
+
+
+def _print_hedge_table(results: List[Dict[str, Any]]) -> None:
+    head = f"{'procs':>8} {'hedging':>8} {'wall s':>9} {'p50 s':>8} {'p99 s':>8} {'hedged':>7}"
+    print(head)
+    print("-" * len(head))
+    for r in results:
+        lat = r["llm_latency"].get("extract", {})
+        print(
+            f"{r['procedures']:>8} {r['hedging']:>8} {r['wall_seconds']:>9.3f} "
+            f"{lat.get('p50') or 0:>8.3f} {lat.get('p99') or 0:>8.3f} {r.get('hedged', 0):>7}"
+        )
+
+
+def run_parent(args: argparse.Namespace) -> None:
+    # --hedge-compare: every size without, then with request hedging
+    variants = [("off", [])]
+    if args.hedge_compare is not None:
+        # hedges take an API slot too: leave one free next to the sequential extract calls
+        cap = [] if "--max-concurrency" in args.pipeline_args else ["--max-concurrency", "2"]
+        variants = [("off", cap), (f"p{args.hedge_compare:g}", cap + ["--hedge-percentile", str(args.hedge_compare)])]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="pipeline_bench_") as tmp:
+        for size in args.sizes:
+            for label, extra in variants:
+                workdir = Path(tmp) / f"n{size}_{label}"
+                result = workdir / "result.json"
+                workdir.mkdir(parents=True, exist_ok=True)
+                print(f"[bench] {size} procedures (hedging {label}) ..." if len(variants) > 1 else f"[bench] {size} procedures ...", flush=True)
+                out = None if args.verbose else subprocess.DEVNULL
+                cmd = _child_cmd(args, size, workdir, result)
+                cmd += extra if args.pipeline_args else (["--"] + extra if extra else [])
+                subprocess.run(cmd, check=True, stdout=out)
+                with result.open("r", encoding="utf-8") as f:
+                    res = json.load(f)
+                res["hedging"] = label
+                res["hedged"] = int(sum(
+                    c["value"] for c in res["metrics"]["counters"].get("llm_hedges_total", [])
+                    if c["labels"].get("outcome") in ("won", "lost", "failed")
+                ))
+                results.append(res)
+
+    _print_table(results)
+    if len(variants) > 1:
+        print()
+        _print_hedge_table(results)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"[bench] report written: {args.report}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark (replayed / synthetic APIs)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Numbers of procedures to run")
+    parser.add_argument("--input", default=str(DEFAULT_INPUT), help="Seed input JSON to scale up")
+    parser.add_argument("--fixtures", default=None, help="Recorded responses (JSON), see module docstring")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Mean injected latency per LLM call (s)")
+    parser.add_argument("--pubchem-latency", type=float, default=0.0, help="Mean injected latency per PubChem call (s)")
+    parser.add_argument("--opsin-latency", type=float, default=0.0, help="Mean injected latency per OPSIN call (s)")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="Lognormal sigma of injected latency (0 = fixed)")
+    parser.add_argument(
+        "--novel-name-rate",
+        type=float,
+        default=0.3,
+        help="Share of synthetic products with a unique, unresolvable name",
+    )
+    parser.add_argument(
+        "--pubchem-compare",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Only compare the per-name and batch PubChem paths on N names (local stand-in)",
+    )
+    parser.add_argument(
+        "--hedge-compare",
+        type=float,
+        default=None,
+        metavar="P",
+        help="Run every size without and with LLM request hedging at percentile P; compare extract p50/p99",
+    )
+    parser.add_argument(
+        "--cold-start",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Only time fresh pipeline.py processes (every command's --help, single-step re-runs), N runs each",
+    )
+    parser.add_argument("--report", default=None, help="Write all results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show pipeline output")
+    parser.add_argument("pipeline_args", nargs=argparse.REMAINDER, help="Extra pipeline.py options after --")
+    # internal (child process)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.pipeline_args and args.pipeline_args[0] == "--":
+        args.pipeline_args = args.pipeline_args[1:]
+
+    if args.child:
+        run_child(args)
+    elif args.cold_start:
+        result = measure_cold_start(args)
+        _print_cold_start(result)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+    elif args.pubchem_compare:
+        result = compare_pubchem(args.pubchem_compare, args.pubchem_latency)
+        print(json.dumps(result, indent=2))
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+    else:
+        run_parent(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+"""
+Token / cost budget shared by every LLM call of a run.
+
+Limits (all optional):
+- max_run_tokens      : prompt + completion tokens for the whole run
+- max_tokens_per_min  : sliding 60 s window
+- max_cost_usd        : estimated spend (see PRICES_PER_1M)
+
+Stages have priorities: extract and time calls may use the whole budget and
+wait for the per-minute window; SMILES name fallbacks ("smiles") are refused
+as soon as less than `reserve` of a limit is left, so they never starve the
+extraction. Refused calls raise BudgetExceeded.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+# USD per 1M tokens (input, output). Unknown models only count tokens.
+PRICES_PER_1M: Dict[str, tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+
+# lower = more important
+STAGE_PRIORITY: Dict[str, int] = {"extract": 0, "time": 1, "smiles": 2}
+LOW_PRIORITY = 2
+
+WINDOW_S = 60.0
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English/chemistry text
+    return max(1, len(text) // 4)
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    price = PRICES_PER_1M.get(model)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+class BudgetManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(
+        self,
+        max_run_tokens: Optional[int] = None,
+        max_tokens_per_min: Optional[int] = None,
+        max_cost_usd: Optional[float] = None,
+        reserve: float = 0.2,
+    ) -> None:
+        with self._lock:
+            self.max_run_tokens = max_run_tokens
+            self.max_tokens_per_min = max_tokens_per_min
+            self.max_cost_usd = max_cost_usd
+            self.reserve = reserve
+            self.spent_tokens = 0
+            self.spent_usd = 0.0
+            # estimates of the calls in flight, counted against the run limits
+            # until record() / release() settles them
+            self.reserved_tokens = 0
+            self.reserved_usd = 0.0
+            self.per_stage: Dict[str, Dict[str, Any]] = {}
+            # tickets in the per-minute window (only with max_tokens_per_min)
+            self._window: Deque[List[float]] = deque()
+
+    @property
+    def enabled(self) -> bool:
+        return any(x is not None for x in (self.max_run_tokens, self.max_tokens_per_min, self.max_cost_usd))
+
+    def _stage(self, stage: str) -> Dict[str, Any]:
+        return self.per_stage.setdefault(
+            stage, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "usd": 0.0, "refused": 0}
+        )
+
+    def _refuse(self, stage: str, why: str) -> None:
+        self._stage(stage)["refused"] += 1
+        raise BudgetExceeded(f"{stage}: {why}")
+
+    def _window_tokens(self, now: float) -> float:
+        while self._window and self._window[0][0] <= now - WINDOW_S:
+            self._window.popleft()
+        return sum(t[1] for t in self._window)
+
+    def _settle(self, ticket: List[float]) -> None:
+        # ticket = [timestamp, window tokens, reserved tokens, reserved usd]
+        self.reserved_tokens -= int(ticket[2])
+        self.reserved_usd -= ticket[3]
+        ticket[2] = ticket[3] = 0.0
+
+    def acquire(self, stage: str, model: str, est_tokens: int, wait: bool = True) -> Optional[List[float]]:
+        """
+        Reserve est_tokens for one call. Blocks while the per-minute window is
+        full (high-priority stages, unless wait=False) or raises BudgetExceeded.
+        Returns a ticket to pass to `record()` (or `release()`); until then
+        est_tokens count against the run limits, so concurrent calls cannot
+        overshoot them together.
+        """
+        if not self.enabled:
+            return None
+        low = STAGE_PRIORITY.get(stage, 1) >= LOW_PRIORITY
+        share = (1.0 - self.reserve) if low else 1.0
+
+        est_cost = call_cost(model, est_tokens, 0) or 0.0
+
+        while True:
+            with self._lock:
+                committed = self.spent_tokens + self.reserved_tokens
+                if self.max_run_tokens is not None and committed + est_tokens > self.max_run_tokens * share:
+                    self._refuse(stage, f"run token budget reached ({committed}/{self.max_run_tokens}, incl. in flight)")
+                committed_usd = self.spent_usd + self.reserved_usd
+                if self.max_cost_usd is not None and committed_usd + est_cost > self.max_cost_usd * share:
+                    self._refuse(stage, f"cost budget reached (${committed_usd:.4f}/${self.max_cost_usd}, incl. in flight)")
+
+                now = time.monotonic()
+                ticket = [now, float(est_tokens), float(est_tokens), est_cost]
+                if self.max_tokens_per_min is None:
+                    self.reserved_tokens += est_tokens
+                    self.reserved_usd += est_cost
+                    return ticket
+
+                used = self._window_tokens(now)
+                if used == 0 or used + est_tokens <= self.max_tokens_per_min * share:
+                    self._window.append(ticket)
+                    self.reserved_tokens += est_tokens
+                    self.reserved_usd += est_cost
+                    return ticket
+                if low or not wait:
+                    self._refuse(stage, "per-minute token budget reached")
+                sleep_s = self._window[0][0] + WINDOW_S - now
+            time.sleep(min(max(sleep_s, 0.05), 1.0))
+
+    def record(
+        self,
+        ticket: Optional[List[float]],
+        stage: str,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+    ) -> None:
+        cost = call_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            if ticket is not None:
+                ticket[1] = float(prompt_tokens + completion_tokens)
+                self._settle(ticket)
+            self.spent_tokens += prompt_tokens + completion_tokens
+            if cost is not None:
+                self.spent_usd += cost
+            st = self._stage(stage)
+            st["calls"] += 1
+            st["prompt_tokens"] += prompt_tokens
+            st["completion_tokens"] += completion_tokens
+            st["usd"] += cost or 0.0
+
+    def release(self, ticket: Optional[List[float]]) -> None:
+        """Give back a reservation for a call that failed before any usage."""
+        if ticket is None:
+            return
+        with self._lock:
+            ticket[1] = 0.0
+            self._settle(ticket)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "limits": {
+                    "max_run_tokens": self.max_run_tokens,
+                    "max_tokens_per_min": self.max_tokens_per_min,
+                    "max_cost_usd": self.max_cost_usd,
+                    "reserve": self.reserve,
+                },
+                "spent_tokens": self.spent_tokens,
+                "spent_usd": round(self.spent_usd, 6),
+                "per_stage": {
+                    k: {**v, "usd": round(v["usd"], 6)} for k, v in sorted(self.per_stage.items())
+                },
+            }
+
+
+BUDGET = BudgetManager()
@@ -2,24 +2,22 @@
 from __future__ import annotations
 
 import os
+import re
 import time
 import json
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Callable, Iterable, Iterator, List, Tuple
 
-import pandas as pd
-from openai import OpenAI
+from budget import BudgetExceeded
+from llm import chat_completion
+from metrics import METRICS, timed_stage
 
+TABLE_COLUMNS = 8  # | Reactants | ... | Yield |
 
-def get_completion(prompt: str, model: str = "gpt-4o-mini") -> str:
+
+def get_completion(prompt: str, model: str = "gpt-4o-mini", on_text: Optional[Callable[[str], None]] = None) -> str:
     messages = [{"role": "user", "content": prompt}]
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0,
-    )
-    return response.choices[0].message.content
+    return chat_completion(messages, model=model, temperature=0, stage="extract", on_text=on_text)
 
 
 def build_prompt(title: str, text: str) -> str:
@@ -124,17 +122,195 @@ Procedure:<'''{text}'''>
 """.strip()
 
 
-def extract_one(title: str, procedure: str, model: str) -> str:
+def _is_missing(cell: str) -> bool:
+    return cell.strip().lower() in ("", "n/a", "na", "none", "-")
+
+
+def validate_table(summary: str) -> Tuple[bool, str]:
+    """
+    Cheap sanity check of an extract answer, used to decide whether a
+    small-model answer can be kept. Returns (ok, reason).
+    """
+    if not summary or "|" not in summary:
+        return False, "no_table"
+    lines = summary.strip().split("\n")[2:]  # same header skip as structure_step
+    rows = [[x.strip() for x in line.split("|")[1:-1]] for line in lines if "|" in line]
+    if not rows:
+        return False, "no_rows"
+    if any(len(r) != TABLE_COLUMNS for r in rows):
+        return False, "column_count"
+    if not any(not _is_missing(r[0]) and not _is_missing(r[2]) for r in rows):
+        return False, "empty_reactants_or_products"
+    for r in rows:
+        for value in re.findall(r"(\d+(?:\.\d+)?)\s*%", r[7]):
+            if float(value) > 100:
+                return False, "implausible_yield"
+    return True, ""
+
+
+class TableRowParser:
+    """
+    Incremental structure_step.tabulate_condition for one procedure: feed()
+    the answer as it arrives; on_row([Index_i, 8 cells]) is called as soon as
+    a row's line is complete. Same header skip, numbering and rows as
+    tabulate_condition on the whole answer.
+    """
+
+    def __init__(self, index: str, on_row: Callable[[List[str]], None]):
+        self.index = index
+        self.on_row = on_row
+        self.rows = 0
+        self._buf = ""
+        self._lines = 0
+        self._started = False
+
+    def feed(self, text: str) -> None:
+        if not self._started:
+            # tabulate_condition strips the answer before skipping the header
+            text = text.lstrip()
+            if not text:
+                return
+            self._started = True
+        self._buf += text
+        *lines, self._buf = self._buf.split("\n")
+        for line in lines:
+            self._line(line)
+
+    def close(self) -> None:
+        last, self._buf = self._buf.rstrip(), ""
+        if last:
+            self._line(last)
+
+    def _line(self, line: str) -> None:
+        self._lines += 1
+        if self._lines <= 2:  # header + separator
+            return
+        row = [f"{self.index}_{self._lines - 2}"] + [x.strip() for x in line.split("|")[1:-1]]
+        if len(row) == TABLE_COLUMNS + 1:
+            self.rows += 1
+            self.on_row(row)
+
+
+def extract_one(
+    title: str,
+    procedure: str,
+    model: str,
+    fast_model: Optional[str] = None,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Extract one procedure. With `fast_model`, the fast model is tried first and
+    its table is kept if it passes validate_table(); otherwise the procedure is
+    re-run on `model`.
+
+    With `on_text`, the answer is streamed to it while it is generated. A fast
+    model answer is only passed on (in one piece) once it passed validation.
+    """
     prompt = build_prompt(title, procedure)
-    return get_completion(prompt, model=model)
+    if not fast_model or fast_model == model:
+        return get_completion(prompt, model=model, on_text=on_text)
+
+    t0 = time.perf_counter()
+    try:
+        summary = get_completion(prompt, model=fast_model)
+        ok, reason = validate_table(summary)
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        ok, reason = False, f"error:{type(e).__name__}"
+    METRICS.observe("extract_attempt_latency_seconds", time.perf_counter() - t0, tier="fast", model=fast_model)
+    if ok:
+        METRICS.inc("extract_fast_accepted_total", model=fast_model)
+        if on_text is not None:
+            on_text(summary)
+        return summary
+
+    METRICS.inc("extract_escalations_total", reason=reason, model=model)
+    t0 = time.perf_counter()
+    summary = get_completion(prompt, model=model, on_text=on_text)
+    METRICS.observe("extract_attempt_latency_seconds", time.perf_counter() - t0, tier="large", model=model)
+    return summary
+
+
+def iter_procedures(data: Dict[str, Any]) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yield (Index, Title, Procedure) for every procedure of the input JSON,
+    Index = <reaction_key>_<procedure_index>.
+    """
+    for reaction_key, payload in data.items():
+        title = payload.get("Title", "")
+        procedures = payload.get("Procedure", [])
+
+        # Normalisation : si jamais Procedure n’est pas une liste
+        if isinstance(procedures, str):
+            procedures = [procedures]
+
+        for i, proc in enumerate(procedures, start=1):
+            yield f"{reaction_key}_{i}", title, proc
 
 
+def extract_procedures(
+    procedures: Iterable[Tuple[str, str, str]],
+    model: str = "gpt-4o-mini",
+    sleep_s: float = 2.0,
+    fast_model: Optional[str] = None,
+    retry_queue=None,
+    errors: Optional[List[str]] = None,
+    on_row: Optional[Callable[[List[str]], None]] = None,
+) -> Dict[str, str]:
+    """
+    Extract (Index, Title, Procedure) items one by one.
+    Returns {Index: summary}; failures go to `retry_queue`, else to `errors`.
+
+    With `on_row`, answers are streamed and every table row is passed to it
+    as soon as it is complete (see TableRowParser), e.g. to start resolving
+    names before the procedure, or the step, is finished. A procedure that
+    fails mid-answer may already have passed some rows.
+    """
+    summaries: Dict[str, str] = {}
+    for idx, title, proc in procedures:
+        if sleep_s and sleep_s > 0:
+            time.sleep(sleep_s)
+
+        parser = None
+        if on_row is not None:
+            t0 = time.perf_counter()
+
+            def first_row(row: List[str], t0: float = t0) -> None:
+                if parser.rows == 1:
+                    METRICS.observe("extract_first_row_seconds", time.perf_counter() - t0)
+                on_row(row)
+
+            parser = TableRowParser(idx, first_row)
+        try:
+            summaries[idx] = extract_one(
+                title, proc, model=model, fast_model=fast_model,
+                on_text=parser.feed if parser is not None else None,
+            )
+            if parser is not None:
+                parser.close()
+                METRICS.inc("extract_stream_rows_total", parser.rows)
+        except Exception as e:
+            if retry_queue is not None:
+                retry_queue.add("extract", idx, e)
+            elif errors is not None:
+                errors.append(f"{idx}: {e}\n")
+            continue
+        if retry_queue is not None:
+            retry_queue.resolve("extract", idx)
+    return summaries
+
+
+@timed_stage("extract")
 def run_extract(
     input_json_path: str | Path,
     output_summary_csv_path: str | Path,
     model: str = "gpt-4o-mini",
     sleep_s: float = 2.0,
     error_txt_path: Optional[str | Path] = None,
+    fast_model: Optional[str] = None,
+    retry_queue=None,
+    on_row: Optional[Callable[[List[str]], None]] = None,
 ) -> Path:
     """
     Pipeline step 1:
@@ -142,8 +318,19 @@ def run_extract(
     - Index : <reaction_key>_<procedure_index>
     - Summary : the markdown table returned by the LLM
 
+    With `fast_model`, each procedure is tried on the fast model first and only
+    escalated to `model` when the returned table fails validation.
+
+    Failed procedures go to `retry_queue` (a RetryQueue) when given, else to
+    the *_names_error.txt file.
+
+    With `on_row`, answers are streamed and each table row (as in
+    structure_step.tabulate_condition) is passed to it as soon as it arrives.
+
     Returns the path to the created CSV.
     """
+    import pandas as pd
+
     if not os.getenv("OPENAI_API_KEY"):
         raise RuntimeError("OPENAI_API_KEY is not set in environment variables.")
 
@@ -154,38 +341,23 @@ def run_extract(
     if error_txt_path is None:
         error_txt_path = output_summary_csv_path.with_suffix("").as_posix() + "_names_error.txt"
     error_txt_path = Path(error_txt_path)
-    error_txt_path.parent.mkdir(parents=True, exist_ok=True)
 
     with input_json_path.open("r", encoding="utf-8") as f:
         data: Dict[str, Any] = json.load(f)
 
-    rows: List[Dict[str, str]] = []
     errors: List[str] = []
+    summaries = extract_procedures(
+        iter_procedures(data), model=model, sleep_s=sleep_s, fast_model=fast_model,
+        retry_queue=retry_queue, errors=errors, on_row=on_row,
+    )
 
-    for reaction_key, payload in data.items():
-        title = payload.get("Title", "")
-        procedures = payload.get("Procedure", [])
-
-        # Normalisation : si jamais Procedure n’est pas une liste
-        if isinstance(procedures, str):
-            procedures = [procedures]
-
-        for i, proc in enumerate(procedures, start=1):
-            if sleep_s and sleep_s > 0:
-                time.sleep(sleep_s)
-
-            idx = f"{reaction_key}_{i}"
-            try:
-                summary = extract_one(title, proc, model=model)
-                rows.append({"Index": idx, "Summary": summary})
-            except Exception as e:
-                errors.append(f"{idx}: {e}\n")
-
-    df = pd.DataFrame(rows, columns=["Index", "Summary"])
+    df = pd.DataFrame(list(summaries.items()), columns=["Index", "Summary"])
     df.to_csv(output_summary_csv_path, index=False)
 
-    with error_txt_path.open("w", encoding="utf-8") as f:
-        f.writelines(errors)
+    if retry_queue is None:
+        error_txt_path.parent.mkdir(parents=True, exist_ok=True)
+        with error_txt_path.open("w", encoding="utf-8") as f:
+            f.writelines(errors)
 
     return output_summary_csv_path
 
@@ -0,0 +1,458 @@
+# -*- coding: UTF-8 -*-
+"""
+Shared OpenAI call path for every step (extract, time, SMILES name fallback).
+
+Responses are memoized in-process on (model, temperature, messages), so a
+batch run over many input files never pays twice for the same prompt.
+Each call records latency, token usage and retries in `metrics.METRICS` and
+is checked against / charged to the run budget (`budget.BUDGET`).
+
+Optional request hedging (`HEDGING.configure(percentile=...)`): a call that
+has not answered after that percentile of the latencies observed so far for
+its (stage, model) is sent a second time; the first answer wins and the
+other request is cancelled (its HTTP client is closed).
+
+Streaming (`chat_completion(..., on_text=fn)`): fn receives the answer piece
+by piece as the API generates it; memo, budget and metrics are unchanged.
+Streamed calls are not hedged, and are only retried before the first piece.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from api_limits import api_slot, try_api_slot
+from budget import BUDGET, BudgetExceeded, estimate_tokens
+from metrics import COUNT_BUCKETS, METRICS
+
+MAX_RETRIES = 2
+RETRY_BACKOFF_S = 1.0
+
+_cache: Dict[str, str] = {}
+_cache_lock = threading.Lock()
+# identical prompts issued concurrently (parallel files) wait for the first call
+_inflight: Dict[str, threading.Event] = {}
+
+
+def _cache_key(messages: List[Dict[str, str]], model: str, temperature: Optional[float]) -> str:
+    return json.dumps([model, temperature, messages], ensure_ascii=False, sort_keys=True)
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def cache_size() -> int:
+    with _cache_lock:
+        return len(_cache)
+
+
+def _new_client():
+    from openai import OpenAI
+
+    # retries are handled (and counted) in chat_completion
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+def _send(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: Optional[float],
+    on_client=None,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    Single raw API call (no cache, no limits, no retry).
+    Returns (content, usage) with usage = {"prompt_tokens", "completion_tokens"}.
+    on_client(client) is called before the request (lets a hedge cancel it).
+    """
+    kwargs: Dict[str, Any] = {}
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+
+    client = _new_client()
+    if on_client is not None:
+        on_client(client)
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        **kwargs,
+    )
+    usage = getattr(response, "usage", None)
+    return response.choices[0].message.content, {
+        "prompt_tokens": int(getattr(usage, "prompt_tokens", 0) or 0),
+        "completion_tokens": int(getattr(usage, "completion_tokens", 0) or 0),
+    }
+
+
+def _send_stream(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: Optional[float],
+    on_text: Callable[[str], None],
+) -> Tuple[str, Dict[str, int]]:
+    """
+    _send() with a streamed response: on_text(piece) is called for every
+    content delta as it arrives. Returns the whole (content, usage).
+    """
+    kwargs: Dict[str, Any] = {}
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+
+    client = _new_client()
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        # usage comes in a last chunk without choices
+        stream_options={"include_usage": True},
+        **kwargs,
+    )
+    parts: List[str] = []
+    usage = None
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        for choice in chunk.choices or []:
+            piece = getattr(choice.delta, "content", None)
+            if piece:
+                parts.append(piece)
+                on_text(piece)
+    return "".join(parts), {
+        "prompt_tokens": int(getattr(usage, "prompt_tokens", 0) or 0),
+        "completion_tokens": int(getattr(usage, "completion_tokens", 0) or 0),
+    }
+
+
+class HedgePolicy:
+    """
+    When to hedge, and what it did.
+
+    - percentile   : hedge once a call is slower than this percentile of the
+                     last `window` latencies of its (stage, model); None = off
+    - min_samples  : no hedging before that many calls were observed
+    - max_fraction : cap on hedged calls / calls (extra spend); hedges are
+                     also charged to the run budget and skipped when it is tight
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(
+        self,
+        percentile: Optional[float] = None,
+        max_fraction: float = 0.1,
+        min_samples: int = 20,
+        window: int = 500,
+    ) -> None:
+        with self._lock:
+            self.percentile = percentile
+            self.max_fraction = max_fraction
+            self.min_samples = min_samples
+            self.window = window
+            self._recent: Dict[Tuple[str, str], Deque[float]] = {}
+            self.stats: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.percentile is not None
+
+    def _stage(self, stage: str) -> Dict[str, Any]:
+        return self.stats.setdefault(stage, {"calls": 0, "hedged": 0, "wins": 0, "extra_tokens": 0})
+
+    def delay(self, stage: str, model: str) -> Optional[float]:
+        """Seconds after which to hedge a new call, or None (not enough data)."""
+        with self._lock:
+            self._stage(stage)["calls"] += 1
+            recent = self._recent.get((stage, model))
+            if not recent or len(recent) < self.min_samples:
+                return None
+            ordered = sorted(recent)
+            return ordered[min(len(ordered) - 1, int(round(self.percentile / 100 * (len(ordered) - 1))))]
+
+    def try_hedge(self, stage: str) -> bool:
+        """Take one hedge from the max_fraction allowance."""
+        with self._lock:
+            st = self._stage(stage)
+            calls = sum(s["calls"] for s in self.stats.values())
+            hedged = sum(s["hedged"] for s in self.stats.values())
+            if hedged + 1 > self.max_fraction * calls:
+                return False
+            st["hedged"] += 1
+            return True
+
+    def observe(self, stage: str, model: str, latency: float, won: bool = False, extra_tokens: int = 0) -> None:
+        """latency: what the caller waited for the answer."""
+        with self._lock:
+            self._recent.setdefault((stage, model), deque(maxlen=self.window)).append(latency)
+            st = self._stage(stage)
+            st["wins"] += int(won)
+            st["extra_tokens"] += extra_tokens
+
+    def report(self) -> Dict[str, Any]:
+        """Hedge rate per stage, with the p50 / p99 of LLM call latency (hedging included)."""
+        with self._lock:
+            per_stage = {}
+            for stage, st in sorted(self.stats.items()):
+                lat = METRICS.histogram_stats("llm_call_latency_seconds", stage=stage) or {}
+                per_stage[stage] = {
+                    "calls": st["calls"],
+                    "hedged": st["hedged"],
+                    "hedge_rate": round(st["hedged"] / st["calls"], 4) if st["calls"] else None,
+                    "hedge_wins": st["wins"],
+                    "extra_tokens_est": st["extra_tokens"],
+                    "p50_s": lat.get("p50"),
+                    "p99_s": lat.get("p99"),
+                }
+            calls = sum(s["calls"] for s in per_stage.values())
+            hedged = sum(s["hedged"] for s in per_stage.values())
+            return {
+                "percentile": self.percentile,
+                "max_fraction": self.max_fraction,
+                "min_samples": self.min_samples,
+                "calls": calls,
+                "hedged": hedged,
+                "hedge_rate": round(hedged / calls, 4) if calls else None,
+                "hedge_wins": sum(s["hedge_wins"] for s in per_stage.values()),
+                "per_stage": per_stage,
+            }
+
+
+HEDGING = HedgePolicy()
+
+
+class _Attempt:
+    """
+    One _send() in a background thread; cancel() closes its HTTP client.
+    The primary waits for an api_slot() (`started` is set and `t_start`
+    taken once it holds one); a hedge is given a slot already taken with
+    try_api_slot() and its `release_slot`.
+    """
+
+    def __init__(self, messages, model, temperature, done: threading.Event, release_slot=None):
+        self.args = (messages, model, temperature)
+        self.hedge = release_slot is not None
+        self.release_slot = release_slot
+        self.done = done
+        self.started = threading.Event()
+        self.t_start = time.perf_counter()
+        self.finished = False
+        self.cancelled = False
+        self.client = None
+        self.result: Optional[Tuple[str, Dict[str, int]]] = None
+        self.error: Optional[Exception] = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            if self.hedge:
+                try:
+                    self._send()
+                finally:
+                    self.release_slot()
+            else:
+                with api_slot():
+                    self._send()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.started.set()
+            self.finished = True
+            self.done.set()
+
+    def _send(self) -> None:
+        self.t_start = time.perf_counter()
+        self.started.set()
+        if not self.cancelled:
+            self.result = _send(*self.args, on_client=self._set_client)
+
+    def _set_client(self, client) -> None:
+        self.client = client
+        if self.cancelled:
+            client.close()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        client = self.client
+        if client is not None and not self.finished:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+def _send_hedged(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: Optional[float],
+    stage: str,
+    est_tokens: int,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    _send() with at most one hedge, per HEDGING. Latency (and the hedge
+    delay) is counted from the moment the primary holds its api_slot(), so
+    waiting for a local slot neither triggers hedges nor skews the
+    percentile. The hedge needs a free slot too; without one it is skipped.
+    """
+    delay = HEDGING.delay(stage, model)
+    if delay is None:
+        with api_slot():
+            t0 = time.perf_counter()
+            res = _send(messages, model, temperature)
+        HEDGING.observe(stage, model, time.perf_counter() - t0)
+        return res
+
+    done = threading.Event()
+    primary = _Attempt(messages, model, temperature, done)
+    primary.started.wait()
+    t0 = primary.t_start
+    hedge_now = False
+    release_slot = None
+    if not done.wait(max(0.0, delay - (time.perf_counter() - t0))):
+        release_slot = try_api_slot()
+        if release_slot is None:
+            METRICS.inc("llm_hedges_total", stage=stage, model=model, outcome="skipped_slot")
+        else:
+            try:
+                ticket = BUDGET.acquire(stage, model, est_tokens, wait=False)
+                hedge_now = HEDGING.try_hedge(stage)
+                if not hedge_now:
+                    BUDGET.release(ticket)
+            except BudgetExceeded:
+                METRICS.inc("llm_hedges_total", stage=stage, model=model, outcome="skipped_budget")
+            if not hedge_now:
+                release_slot()
+    if not hedge_now:
+        done.wait()
+        if primary.error is not None:
+            raise primary.error
+        HEDGING.observe(stage, model, time.perf_counter() - t0)
+        return primary.result
+
+    hedge = _Attempt(messages, model, temperature, done, release_slot=release_slot)
+    attempts = [primary, hedge]
+    while True:
+        done.wait()
+        done.clear()
+        winner = next((a for a in attempts if a.finished and a.error is None), None)
+        if winner is not None or all(a.finished for a in attempts):
+            break
+
+    elapsed = time.perf_counter() - t0
+    loser = hedge if winner is primary else primary
+    loser.cancel()
+    # the loser's prompt was sent (and billed) anyway
+    BUDGET.record(ticket, stage, model, est_tokens, 0)
+    if winner is None:
+        METRICS.inc("llm_hedges_total", stage=stage, model=model, outcome="failed")
+        raise primary.error
+    won = winner is hedge
+    METRICS.inc("llm_hedges_total", stage=stage, model=model, outcome="won" if won else "lost")
+    HEDGING.observe(stage, model, elapsed, won, est_tokens)
+    return winner.result
+
+
+def _is_retryable(exc: Exception) -> bool:
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(exc, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+
+def chat_completion(
+    messages: List[Dict[str, str]],
+    model: str = "gpt-4o-mini",
+    temperature: Optional[float] = None,
+    stage: str = "other",
+    on_text: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Memoized chat completion. `stage` only labels the call in the run metrics.
+    With `on_text`, the answer is streamed to it as it is generated (a memo
+    hit is passed in one piece).
+    """
+    key = _cache_key(messages, model, temperature)
+    while True:
+        with _cache_lock:
+            if key in _cache:
+                METRICS.inc("llm_cache_hits_total", stage=stage, model=model)
+                content = _cache[key]
+                break
+            pending = _inflight.get(key)
+            if pending is None:
+                _inflight[key] = threading.Event()
+                content = None
+                break
+        pending.wait()
+    if content is not None:
+        if on_text is not None:
+            on_text(content)
+        return content
+
+    try:
+        content = _call_with_retries(messages, model, temperature, stage, on_text)
+        with _cache_lock:
+            _cache[key] = content
+        return content
+    finally:
+        with _cache_lock:
+            _inflight.pop(key).set()
+
+
+def _call_with_retries(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: Optional[float],
+    stage: str,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> str:
+    # raises BudgetExceeded if the stage is not allowed to spend any more
+    est_tokens = estimate_tokens("".join(m["content"] for m in messages))
+    ticket = BUDGET.acquire(stage, model, est_tokens)
+
+    retries = 0
+    t0 = time.perf_counter()
+    streamed = False
+
+    def emit(piece: str) -> None:
+        nonlocal streamed
+        if not streamed:
+            streamed = True
+            METRICS.observe("llm_first_token_seconds", time.perf_counter() - t0, stage=stage, model=model)
+        on_text(piece)
+
+    while True:
+        try:
+            if on_text is not None:
+                with api_slot():
+                    content, usage = _send_stream(messages, model, temperature, emit)
+            elif HEDGING.enabled:
+                content, usage = _send_hedged(messages, model, temperature, stage, est_tokens)
+            else:
+                with api_slot():
+                    content, usage = _send(messages, model, temperature)
+            break
+        except Exception as e:
+            # once pieces were handed out, a retry would repeat them
+            if retries >= MAX_RETRIES or streamed or not _is_retryable(e):
+                BUDGET.release(ticket)
+                METRICS.inc("llm_errors_total", stage=stage, model=model, error=type(e).__name__)
+                METRICS.inc("llm_retries_total", retries, stage=stage, model=model)
+                raise
+            retries += 1
+            time.sleep(RETRY_BACKOFF_S * 2 ** (retries - 1))
+
+    METRICS.observe("llm_call_latency_seconds", time.perf_counter() - t0, stage=stage, model=model)
+    METRICS.observe("llm_call_retries", retries, COUNT_BUCKETS, stage=stage, model=model)
+    METRICS.inc("llm_calls_total", stage=stage, model=model)
+    METRICS.inc("llm_retries_total", retries, stage=stage, model=model)
+    METRICS.inc("llm_prompt_tokens_total", usage["prompt_tokens"], stage=stage, model=model)
+    METRICS.inc("llm_completion_tokens_total", usage["completion_tokens"], stage=stage, model=model)
+    BUDGET.record(ticket, stage, model, usage["prompt_tokens"], usage["completion_tokens"])
+    return content
@@ -0,0 +1,283 @@
+# -*- coding: UTF-8 -*-
+"""
+Pipeline step 5: table + standardized times + SMILES lookup -> final CSV
+(Title, *_SMILES and *_MolIDs columns).
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import pandas as pd
+
+from metrics import timed_stage
+from molecules import NO_MOLECULE, MoleculeRegistry
+from smiles_step import normalize_name, smart_split_chem_list
+
+
+def _log(msg: str) -> None:
+    print(f"[merge_step] {msg}")
+
+
+def _build_smiles_map(smiles_df: pd.DataFrame) -> dict[str, str]:
+    """
+    Key: normalize_name(Original) -> SMILES or 'Not Found'
+    Role-agnostic: a compound listed as Reactant and Product resolves the same.
+    """
+    def norm(s: str) -> str:
+        return str(s).strip()
+
+    out: dict[str, str] = {}
+
+    # tolerant columns
+    required_cols = {"Original", "SMILES", "Status"}
+    missing = required_cols - set(smiles_df.columns)
+    if missing:
+        raise ValueError(f"smiles_lookup.csv missing columns: {missing}")
+
+    for _, r in smiles_df.iterrows():
+        key = normalize_name(r.get("Original", ""))
+        status = norm(r.get("Status", ""))
+        smi = norm(r.get("SMILES", ""))
+
+        if not key:
+            continue
+
+        if status.upper() == "OK" and smi:
+            out[key] = smi
+        elif key not in out:
+            out[key] = "Not Found"
+
+    return out
+
+
+def _smiles_for_cell(cell_value: str, smiles_map: dict[str, str]) -> str:
+    """
+    Convertit "Reactants" ou "Products" cell -> "SMILES1, SMILES2, ..."
+    - conserve l'ordre des composés
+    - si pas trouvé -> Not Found
+    """
+    names = smart_split_chem_list(cell_value)
+    if not names:
+        return ""
+
+    smiles_list = []
+    for name in names:
+        smiles_list.append(smiles_map.get(normalize_name(name), "Not Found"))
+
+    return ", ".join(smiles_list)
+
+
+def _mol_ids_for_cell(cell_value: str, mol_ids: dict[str, int]) -> str:
+    """Same as _smiles_for_cell with MolIDs ("3, 17"); 0 = not resolved."""
+    names = smart_split_chem_list(cell_value)
+    return ", ".join(str(mol_ids.get(normalize_name(name), NO_MOLECULE)) for name in names)
+
+
+def build_index_title_map(input_json_path):
+    import json
+    from pathlib import Path
+
+    with Path(input_json_path).open("r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    index_title_map = {}
+
+    for reaction_key, payload in data.items():
+        title = payload.get("Title", "")
+        procedures = payload.get("Procedure", [])
+
+        if isinstance(procedures, str):
+            procedures = [procedures]
+
+        # Step 1 output index = reaction_key_1
+        for proc_idx in range(1, len(procedures) + 1):
+            base_index = f"{reaction_key}_{proc_idx}"
+
+            # Step 2 creates rows like base_index_1, base_index_2...
+            # On ne sait pas combien il y aura de lignes,
+            # donc on va mapper dynamiquement plus tard.
+            index_title_map[base_index] = title
+
+    return index_title_map
+
+
+def _time_column(time_df: pd.DataFrame) -> pd.DataFrame:
+    if "Index" not in time_df.columns or "Reaction time" not in time_df.columns:
+        raise ValueError("timetable.csv must contain ['Index', 'Reaction time'].")
+    return time_df[["Index", "Reaction time"]].rename(columns={"Reaction time": "Reaction time (minutes)"})
+
+
+def _finish_merged(
+    merged: pd.DataFrame,
+    index_title_map,
+    smiles_map: dict[str, str],
+    mol_ids: dict[str, int] | None = None,
+    drop_smiles: bool = False,
+) -> pd.DataFrame:
+    """
+    Title + SMILES columns, Title moved to 2nd position (table already merged with times).
+    With mol_ids ({name key: MolID}), MolID columns too; drop_smiles keeps only those.
+    """
+    # --- Add Title column ---
+    merged["Title"] = merged["Index"].apply(
+    lambda x: index_title_map.get(
+        "_".join(x.split("_")[:2]),  # pbfa_1 from pbfa_1_1
+        ""
+    )
+)
+
+    # Ensure columns exist in table
+    if "Reactants" not in merged.columns:
+        merged["Reactants"] = ""
+    if "Products" not in merged.columns:
+        merged["Products"] = ""
+
+    merged["Reactants_SMILES"] = merged["Reactants"].apply(
+        lambda x: _smiles_for_cell(x, smiles_map)
+    )
+    merged["Products_SMILES"] = merged["Products"].apply(
+        lambda x: _smiles_for_cell(x, smiles_map)
+    )
+    if mol_ids is not None:
+        merged["Reactants_MolIDs"] = merged["Reactants"].apply(lambda x: _mol_ids_for_cell(x, mol_ids))
+        merged["Products_MolIDs"] = merged["Products"].apply(lambda x: _mol_ids_for_cell(x, mol_ids))
+        if drop_smiles:
+            merged = merged.drop(columns=["Reactants_SMILES", "Products_SMILES"])
+
+    # Optional: overwrite original Reaction time with standardized minutes if you want
+    # Here we KEEP original + add standardized column.
+    # If you prefer replacing:
+    # merged["Reaction time"] = merged["Reaction time (minutes)"].fillna(merged.get("Reaction time"))
+    cols = list(merged.columns)
+    if "Title" in cols:
+        cols.insert(1, cols.pop(cols.index("Title")))
+        merged = merged[cols]
+    return merged
+
+
+@timed_stage("merge")
+def merge_final(
+    table_csv: Path,
+    timetable_csv: Path,
+    smiles_lookup_csv: Path,
+    output_final_csv: Path, index_title_map,
+    chunk_rows: int | None = None,
+    registry: MoleculeRegistry | None = None,
+    drop_smiles: bool = False,
+) -> Path:
+    """
+    table + times + SMILES -> final CSV. With chunk_rows, the table is
+    streamed (see _merge_final_chunked) and the output is the same.
+
+    With a molecule registry, Reactants_MolIDs / Products_MolIDs are added
+    (and the SMILES columns dropped with drop_smiles); new molecules are
+    saved to the registry file.
+    """
+    if chunk_rows and chunk_rows > 0:
+        return _merge_final_chunked(
+            table_csv, timetable_csv, smiles_lookup_csv, output_final_csv, index_title_map, chunk_rows,
+            registry, drop_smiles,
+        )
+
+    _log("Merging final outputs...")
+
+    table_df = pd.read_csv(table_csv)
+    time_df = pd.read_csv(timetable_csv)
+    smiles_df = pd.read_csv(smiles_lookup_csv)
+
+    # --- Merge time (minutes) ---
+    if "Index" not in table_df.columns:
+        raise ValueError("table.csv must contain 'Index' column.")
+
+    merged = table_df.merge(_time_column(time_df), on="Index", how="left")
+    smiles_map = _build_smiles_map(smiles_df)
+    mol_ids = _intern_molecules(registry, smiles_map)
+    merged = _finish_merged(merged, index_title_map, smiles_map, mol_ids, drop_smiles)
+
+    output_final_csv.parent.mkdir(parents=True, exist_ok=True)
+    merged.to_csv(output_final_csv, index=False)
+
+    _log(f"Final CSV written: {output_final_csv}")
+    return output_final_csv
+
+
+def _intern_molecules(registry: MoleculeRegistry | None, smiles_map: dict[str, str]) -> dict[str, int] | None:
+    """{name key: MolID} for the resolved names; the registry file is updated."""
+    if registry is None:
+        return None
+    mol_ids = registry.intern_all(smiles_map)
+    registry.save()
+    return mol_ids
+
+
+def _unify_dtype(seen: set[str]) -> str:
+    """dtype pandas would infer for a whole column from the dtypes of its chunks."""
+    if len(seen) == 1:
+        return next(iter(seen))
+    if seen <= {"int64", "float64"}:
+        return "float64"
+    return "object"
+
+
+def _merge_final_chunked(
+    table_csv: Path,
+    timetable_csv: Path,
+    smiles_lookup_csv: Path,
+    output_final_csv: Path,
+    index_title_map,
+    chunk_rows: int,
+    registry: MoleculeRegistry | None = None,
+    drop_smiles: bool = False,
+) -> Path:
+    """
+    Bounded-memory merge_final: only the timetable and the SMILES map are kept
+    in memory; the table is read chunk_rows rows at a time and appended to
+    the output.
+
+    A first pass over the table collects each column's dtype per chunk, so
+    every chunk is parsed with the dtype a full read would infer (e.g. a
+    yield column with one blank cell is float everywhere), and whether any
+    row has no time (an int time column then becomes float, as in a full
+    left merge).
+    """
+    _log(f"Merging final outputs ({chunk_rows} rows per chunk)...")
+
+    times = _time_column(pd.read_csv(timetable_csv))
+    smiles_map = _build_smiles_map(pd.read_csv(smiles_lookup_csv))
+    mol_ids = _intern_molecules(registry, smiles_map)
+    time_index = set(times["Index"])
+
+    seen: dict[str, set[str]] = {}
+    unmatched = False
+    for chunk in pd.read_csv(table_csv, chunksize=chunk_rows):
+        if "Index" not in chunk.columns:
+            raise ValueError("table.csv must contain 'Index' column.")
+        for col, dtype in chunk.dtypes.items():
+            seen.setdefault(col, set()).add(str(dtype))
+        unmatched = unmatched or not chunk["Index"].isin(time_index).all()
+    dtypes = {col: _unify_dtype(s) for col, s in seen.items()}
+
+    time_dtype = times["Reaction time (minutes)"].dtype
+    if unmatched and time_dtype.kind in "iu":
+        time_dtype = "float64"
+    elif unmatched and time_dtype.kind == "b":
+        time_dtype = "object"
+
+    output_final_csv.parent.mkdir(parents=True, exist_ok=True)
+    rows = 0
+    header = True
+    for chunk in pd.read_csv(table_csv, chunksize=chunk_rows, dtype=dtypes):
+        merged = chunk.merge(times, on="Index", how="left")
+        merged["Reaction time (minutes)"] = merged["Reaction time (minutes)"].astype(time_dtype)
+        merged = _finish_merged(merged, index_title_map, smiles_map, mol_ids, drop_smiles)
+        merged.to_csv(output_final_csv, index=False, header=header, mode="w" if header else "a")
+        header = False
+        rows += len(merged)
+
+    if header:
+        # header-only table: same output as the in-memory path
+        empty = pd.read_csv(table_csv, nrows=0).merge(times, on="Index", how="left")
+        _finish_merged(empty, index_title_map, smiles_map, mol_ids, drop_smiles).to_csv(output_final_csv, index=False)
+
+    _log(f"Final CSV written: {output_final_csv} ({rows} rows)")
+    return output_final_csv
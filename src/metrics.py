@@ -0,0 +1,315 @@
+# -*- coding: UTF-8 -*-
+"""
+Lightweight run instrumentation (no external dependency).
+
+- stage wall time (`timed_stage` decorator / `METRICS.stage()` context)
+- labelled counters and latency histograms (LLM calls, SMILES backends, ...)
+- JSON report (`run_metrics.json`) and optional Prometheus text endpoint
+"""
+from __future__ import annotations
+
+import bisect
+import functools
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# seconds
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# retries per call
+COUNT_BUCKETS: Tuple[float, ...] = (0, 1, 2, 3, 5)
+
+# Prometheus endpoint address; pass 0.0.0.0 explicitly to expose it on the network
+DEFAULT_METRICS_HOST = "127.0.0.1"
+
+# samples kept per histogram for percentiles (exact below that count)
+RESERVOIR_SIZE = 2048
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(kwargs: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+def _quantile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    pos = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[pos]
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram. Percentiles in the JSON report come from a
+    bounded uniform sample of the observations (reservoir sampling), so
+    memory and observe() cost stay constant on long runs; count, sum, max
+    and the buckets are exact.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, reservoir_size: int = RESERVOIR_SIZE):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # last = +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max: Optional[float] = None
+        self.reservoir_size = reservoir_size
+        self.samples: List[float] = []
+        self._rng = random.Random(0)  # reproducible reports
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(value)
+        else:
+            j = self._rng.randrange(self.count)
+            if j < self.reservoir_size:
+                self.samples[j] = value
+
+    def merge(self, other: "Histogram") -> None:
+        """Add another histogram with the same buckets (reservoirs weighted by count)."""
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other.bucket_counts)]
+        total = self.count + other.count
+        if total and len(self.samples) + len(other.samples) > self.reservoir_size:
+            cap = self.reservoir_size
+            k = min(len(self.samples), round(cap * self.count / total))
+            rest = min(len(other.samples), cap - k)
+            k = min(len(self.samples), cap - rest)  # fill up when the other side is short
+            self.samples = self._rng.sample(self.samples, k) + self._rng.sample(other.samples, rest)
+        else:
+            self.samples = self.samples + other.samples
+        self.count = total
+        self.sum += other.sum
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q: float) -> Optional[float]:
+        return _quantile(sorted(self.samples), q)
+
+    def summary(self) -> Dict[str, Any]:
+        cumulative = 0
+        buckets: Dict[str, int] = {}
+        for bound, n in zip(list(self.buckets) + [float("inf")], self.bucket_counts):
+            cumulative += n
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": _quantile(ordered, 0.50),
+            "p95": _quantile(ordered, 0.95),
+            "p99": _quantile(ordered, 0.99),
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self._t0 = time.perf_counter()
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.counters: Dict[str, Dict[Labels, float]] = {}
+            self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    # ---- recording ----
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+        **labels: Any,
+    ) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram(buckets)
+            hist.observe(value)
+
+    def add_stage_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            st = self.stages.setdefault(stage, {"calls": 0, "wall_seconds": 0.0})
+            st["calls"] += 1
+            st["wall_seconds"] += seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - t0)
+
+    # ---- reading ----
+    def counter_value(self, name: str, **labels: Any) -> float:
+        """Sum of every series of `name` whose labels include `labels`."""
+        want = set(_labels(labels))
+        with self._lock:
+            return sum(v for k, v in self.counters.get(name, {}).items() if want <= set(k))
+
+    def counter_series(self, name: str) -> List[Tuple[Dict[str, str], float]]:
+        with self._lock:
+            return [(dict(k), v) for k, v in sorted(self.counters.get(name, {}).items())]
+
+    def histogram_stats(self, name: str, **labels: Any) -> Optional[Dict[str, Any]]:
+        """Merged summary of every series of `name` whose labels include `labels`."""
+        want = set(_labels(labels))
+        merged: Optional[Histogram] = None
+        with self._lock:
+            for k, h in self.histograms.get(name, {}).items():
+                if not want <= set(k):
+                    continue
+                if merged is None:
+                    merged = Histogram(h.buckets)
+                merged.merge(h)
+        return merged.summary() if merged is not None else None
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+                "wall_seconds": round(time.perf_counter() - self._t0, 6),
+                "stages": {
+                    k: {"calls": int(v["calls"]), "wall_seconds": round(v["wall_seconds"], 6)}
+                    for k, v in self.stages.items()
+                },
+                "counters": {
+                    name: [{"labels": dict(k), "value": v} for k, v in sorted(series.items())]
+                    for name, series in sorted(self.counters.items())
+                },
+                "histograms": {
+                    name: [{"labels": dict(k), **h.summary()} for k, h in sorted(series.items())]
+                    for name, series in sorted(self.histograms.items())
+                },
+            }
+        out["smiles_backends"] = self._backend_summary()
+        return out
+
+    def _backend_summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per-backend call count, hit rate and latency for get_smiles_with_trace."""
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            calls = self.counters.get("smiles_backend_calls_total", {})
+            lat = self.histograms.get("smiles_backend_latency_seconds", {})
+            for key, value in calls.items():
+                d = dict(key)
+                b = out.setdefault(d["backend"], {"calls": 0, "found": 0, "not_found": 0, "error": 0})
+                b["calls"] += int(value)
+                b[d["result"]] = b.get(d["result"], 0) + int(value)
+            for key, hist in lat.items():
+                backend = dict(key)["backend"]
+                if backend in out:
+                    s = hist.summary()
+                    out[backend]["latency"] = {k: s[k] for k in ("mean", "p50", "p95", "p99", "max")}
+        for b in out.values():
+            b["hit_rate"] = round(b["found"] / b["calls"], 4) if b["calls"] else None
+        return out
+
+    def write_json(self, path: str | Path, extra: Optional[Dict[str, Any]] = None) -> Path:
+        """Write report() to `path`; `extra` sections are added at top level."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = self.report()
+        report.update(extra or {})
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        return path
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format."""
+
+        def fmt(name: str, labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return name
+            inner = ",".join(f'{k}="{v}"' for k, v in items)
+            return f"{name}{{{inner}}}"
+
+        lines: List[str] = []
+        with self._lock:
+            lines.append("# TYPE pipeline_stage_seconds_total counter")
+            for stage, st in sorted(self.stages.items()):
+                lines.append(f'{fmt("pipeline_stage_seconds_total", (("stage", stage),))} {st["wall_seconds"]}')
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for k, v in sorted(series.items()):
+                    lines.append(f"{fmt(name, k)} {v}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for k, h in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(list(h.buckets) + [float("inf")], h.bucket_counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        lines.append(f"{fmt(name + '_bucket', k, (('le', le),))} {cumulative}")
+                    lines.append(f"{fmt(name + '_sum', k)} {h.sum}")
+                    lines.append(f"{fmt(name + '_count', k)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def timed_stage(stage: str) -> Callable:
+    """Decorator: record the wall time of each call under `stage`."""
+
+    def deco(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.stage(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+def serve_prometheus(port: int, host: str = DEFAULT_METRICS_HOST) -> ThreadingHTTPServer:
+    """Expose METRICS on http://host:port/metrics from a daemon thread (local only by default)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = METRICS.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # keep pipeline output readable
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,195 @@
+# -*- coding: UTF-8 -*-
+"""
+Molecule registry: every resolved SMILES is canonicalized once and given a
+compact integer MolID, stored in molecules.csv (MolID, SMILES) next to the
+outputs. IDs are stable across runs and shared by every input of an output
+directory, so final outputs can be joined on structures with integers.
+
+Canonicalization uses RDKit when it is installed (the same molecule from
+PubChem and from OPSIN then gets one ID); without it SMILES are only
+trimmed, and identical strings share an ID.
+"""
+from __future__ import annotations
+
+import contextlib
+import functools
+import importlib.util
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+from metrics import METRICS
+
+COLUMNS = ["MolID", "SMILES"]
+# MolID written for a compound without SMILES
+NO_MOLECULE = 0
+
+
+def canonicalizer() -> str:
+    return "rdkit" if importlib.util.find_spec("rdkit") is not None else "none"
+
+
+@functools.lru_cache(maxsize=1)
+def _rdkit_chem():
+    """rdkit.Chem, imported on first use (slow), or None when RDKit is not installed."""
+    try:
+        from rdkit import Chem, RDLogger
+    except ImportError:
+        return None
+    RDLogger.DisableLog("rdApp.*")  # unparsable SMILES are expected (LLM suggestions)
+    return Chem
+
+
+@functools.lru_cache(maxsize=None)
+def canonical_smiles(smiles: str) -> str:
+    """RDKit canonical isomeric SMILES, or the trimmed input (no RDKit / unparsable)."""
+    smiles = str(smiles).strip()
+    Chem = _rdkit_chem()
+    if Chem is None or not smiles:
+        return smiles
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        METRICS.inc("molecule_unparsable_total")
+        return smiles
+    return Chem.MolToSmiles(mol)
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    """Exclusive lock on `path` (created if needed), shared with other processes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after ~10 s; keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class MoleculeRegistry:
+    """
+    Every change is a transaction under an exclusive lock on
+    <path>.lock: molecules.csv is re-read (when it changed on disk) before
+    new IDs are assigned and written back before the lock is released, so
+    processes sharing an output directory never give one MolID to two
+    structures.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        # threads of this process; the file lock covers other processes
+        self._lock = threading.Lock()
+        self._smiles: Dict[int, str] = {}
+        self._ids: Dict[str, int] = {}
+        self._loaded_stat: Optional[tuple] = None
+        with self._lock:
+            self._reload()
+
+    def __len__(self) -> int:
+        return len(self._smiles)
+
+    def _reload(self) -> None:
+        """Merge molecules.csv into memory if it changed since the last read (file wins)."""
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._loaded_stat:
+            return
+        import pandas as pd
+
+        df = pd.read_csv(self.path, dtype={"MolID": int, "SMILES": str}, keep_default_na=False)
+        for mol_id, smi in df[COLUMNS].itertuples(index=False):
+            self._smiles[mol_id] = smi
+            self._ids[smi] = mol_id
+            # entries written without RDKit are found from their canonical form too
+            self._ids.setdefault(canonical_smiles(smi), mol_id)
+        self._loaded_stat = stat
+
+    def _write(self) -> None:
+        """Write molecules.csv (write-then-rename); caller holds both locks."""
+        import pandas as pd
+
+        rows = sorted(self._smiles.items())
+        # per-process name: other processes may save the same registry
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        pd.DataFrame(rows, columns=COLUMNS).to_csv(tmp, index=False)
+        os.replace(tmp, self.path)
+        st = self.path.stat()
+        self._loaded_stat = (st.st_mtime_ns, st.st_size)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock, _file_lock(self.lock_path):
+            self._reload()
+            n = len(self._smiles)
+            yield
+            if len(self._smiles) != n or not self.path.exists():
+                self._write()
+
+    def _intern(self, key: str) -> int:
+        mol_id = self._ids.get(key)
+        if mol_id is None:
+            mol_id = max(self._smiles, default=NO_MOLECULE) + 1
+            self._smiles[mol_id] = key
+            self._ids[key] = mol_id
+            METRICS.inc("molecules_registered_total")
+        return mol_id
+
+    def intern(self, smiles: str) -> int:
+        """MolID of a SMILES, registering (and saving) its canonical form if new."""
+        key = canonical_smiles(smiles)
+        if not key:
+            return NO_MOLECULE
+        with self._transaction():
+            return self._intern(key)
+
+    def intern_all(self, smiles_of: Dict[str, str], missing: Iterable[str] = ("Not Found",)) -> Dict[str, int]:
+        """{name key: SMILES} -> {name key: MolID} in one transaction; unresolved names are left out."""
+        missing = set(missing)
+        keys = {k: canonical_smiles(smi) for k, smi in smiles_of.items() if smi and smi not in missing}
+        with self._transaction():
+            return {k: self._intern(key) if key else NO_MOLECULE for k, key in keys.items()}
+
+    def smiles(self, mol_id: int) -> Optional[str]:
+        return self._smiles.get(mol_id)
+
+    def save(self) -> Path:
+        """Write molecules.csv, merged with what other processes saved meanwhile."""
+        with self._transaction():
+            pass
+        return self.path
+
+
+_registries: Dict[Path, MoleculeRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def open_registry(path: str | Path) -> MoleculeRegistry:
+    """One registry per file and process (parallel inputs share their output directory's)."""
+    path = Path(path).resolve()
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = MoleculeRegistry(path)
+        return _registries[path]
@@ -1,17 +1,52 @@
 # -*- coding: UTF-8 -*-
+"""
+Pipeline CLI: `all` (default) runs the 5 steps; `extract`, `structure`,
+`time`, `smiles` and `merge` run one step on the outputs of the previous
+ones; `worker` / `reduce` / `retry` see the README.
+
+Only stdlib and the small shared modules are imported here: pandas, the
+step modules and their clients are imported by the commands that use
+them, so `--help` or a single light step starts in milliseconds.
+"""
 from __future__ import annotations
 
 import argparse
+import functools
+import glob
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import sys
-import pandas as pd
+from typing import TYPE_CHECKING
 
 # Import tes steps (assume pipeline.py est dans src/ comme les autres)
-from extract_step import run_extract
-from structure_step import run_structure
-from time_step import run_time_standardize
-from smiles_step import run_smiles_lookup, smart_split_chem_list
+# extract_step only loads pandas in run_extract; the other steps are imported where used
+from extract_step import extract_one, extract_procedures, iter_procedures, run_extract
+from api_limits import PUBCHEM_LIMITER, set_max_concurrency
+from budget import BUDGET
+from llm import HEDGING
+from metrics import DEFAULT_METRICS_HOST, METRICS, serve_prometheus, timed_stage
+from molecules import canonicalizer, open_registry
+from pubchem_batch import PUBCHEM_BACKENDS
+from retry_queue import RetryQueue, StepError, retry_items
+from workqueue import WorkQueue, input_name, run_worker
+
+if TYPE_CHECKING:
+    from smiles_step import NamePrefetcher
+
+# moved to merge_step; still importable from here (`from pipeline import merge_final`)
+_MERGE_EXPORTS = ("merge_final", "build_index_title_map")
+
+
+def __getattr__(name: str):
+    # resolved on first access, so importing pipeline does not load pandas
+    if name in _MERGE_EXPORTS:
+        import merge_step
+
+        return getattr(merge_step, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _log(msg: str) -> None:
@@ -23,234 +58,925 @@ def _ensure_exists(path: Path, what: str) -> None:
         raise FileNotFoundError(f"{what} not found: {path}")
 
 
-def _build_smiles_map(smiles_df: pd.DataFrame) -> dict[tuple[str, str], str]:
+def collect_inputs(specs: list[str]) -> list[Path]:
     """
-    Key: (Role, OriginalNameNormalized) -> SMILES or 'Not Found'
+    Expand CLI inputs into a list of JSON files.
+    Each spec can be a file, a directory (all *.json inside) or a glob pattern.
     """
-    def norm(s: str) -> str:
-        return str(s).strip()
-
-    out: dict[tuple[str, str], str] = {}
-
-    # tolerant columns
-    required_cols = {"Role", "Original", "SMILES", "Status"}
-    missing = required_cols - set(smiles_df.columns)
-    if missing:
-        raise ValueError(f"smiles_lookup.csv missing columns: {missing}")
+    paths: list[Path] = []
+    for spec in specs:
+        p = Path(spec)
+        if p.is_dir():
+            found = sorted(p.glob("*.json"))
+        elif glob.has_magic(spec):
+            found = sorted(Path(x) for x in glob.glob(spec, recursive=True))
+        else:
+            _ensure_exists(p, "Input JSON")
+            found = [p]
+        if not found:
+            raise FileNotFoundError(f"No input JSON matched: {spec}")
+        paths.extend(found)
+
+    # dedupe (same file given twice) while keeping order
+    unique: list[Path] = []
+    seen: set[Path] = set()
+    for p in paths:
+        rp = p.resolve()
+        if rp not in seen:
+            seen.add(rp)
+            unique.append(rp)
+
+    stems = [p.stem for p in unique]
+    dup = sorted({s for s in stems if stems.count(s) > 1})
+    if dup:
+        raise ValueError(f"Several inputs share the same file name (outputs would collide): {dup}")
+    return unique
+
+
+def output_paths(output_dir: Path, stem: str, per_input_names: bool) -> dict[str, Path]:
+    """
+    Output files for one input. In batch mode smiles_lookup.csv and
+    final_output.csv are prefixed with the input stem too.
+    """
+    prefix = f"{stem}_" if per_input_names else ""
+    return {
+        "summary": output_dir / f"{stem}_summary.csv",
+        "table": output_dir / f"{stem}_table.csv",
+        "timetable": output_dir / f"{stem}_timetable.csv",
+        "smiles": output_dir / f"{prefix}smiles_lookup.csv",
+        "final": output_dir / f"{prefix}final_output.csv",
+        "retry": output_dir / f"{stem}_retry.json",
+        "dead_letter": output_dir / f"{stem}_dead_letter.jsonl",
+        "fingerprints": output_dir / f"{stem}_fingerprints.json",
+        # shared by every input of the output directory
+        "molecules": output_dir / "molecules.csv",
+    }
+
+
+def open_retry_queue(paths: dict[str, Path]) -> RetryQueue:
+    return RetryQueue(paths["retry"], paths["dead_letter"])
+
+
+def run_one(input_json: Path, paths: dict[str, Path], args: argparse.Namespace) -> Path:
+    """
+    Run the 5 steps for a single input JSON.
+    """
+    retry_queue = open_retry_queue(paths)
+    retry_queue.set_outputs(paths)
+    prefetch = _name_prefetcher(args)
 
-    for _, r in smiles_df.iterrows():
-        role = norm(r.get("Role", ""))
-        original = norm(r.get("Original", ""))
-        status = norm(r.get("Status", ""))
-        smi = norm(r.get("SMILES", ""))
+    try:
+        _extract_step(input_json, paths, args, retry_queue, on_row=prefetch.add_row if prefetch else None)
+        return run_downstream(input_json, paths, args, retry_queue, prefetch)
+    finally:
+        if prefetch:
+            prefetch.close()
 
-        if not role or not original:
-            continue
 
-        if status.upper() == "OK" and smi:
-            out[(role, original)] = smi
-        else:
-            out[(role, original)] = "Not Found"
+def _name_prefetcher(args: argparse.Namespace) -> NamePrefetcher | None:
+    """--stream: extract answers are streamed and their names resolved meanwhile."""
+    if not getattr(args, "stream", False):
+        return None
+    from smiles_step import NamePrefetcher
 
-    return out
+    return NamePrefetcher(args.smiles_model)
 
 
-def _smiles_for_cell(cell_value: str, role: str, smiles_map: dict[tuple[str, str], str]) -> str:
+def run_downstream(
+    input_json: Path,
+    paths: dict[str, Path],
+    args: argparse.Namespace,
+    retry_queue: RetryQueue | None = None,
+    prefetch: NamePrefetcher | None = None,
+) -> Path:
     """
-    Convertit "Reactants" ou "Products" cell -> "SMILES1, SMILES2, ..."
-    - conserve l'ordre des composés
-    - si pas trouvé -> Not Found
+    Steps 2-5 from an existing *_summary.csv (normal run, or queue reducer).
+    `prefetch` (names resolved during a streamed extract) is drained before step 4.
     """
-    names = smart_split_chem_list(cell_value)
-    if not names:
-        return ""
+    _structure_step(input_json, paths, args)
+    _time_step(input_json, paths, args)
+    if prefetch is not None:
+        prefetch.close()
+    _smiles_step(input_json, paths, args, retry_queue)
+    return _final_step(input_json, paths, args)
+
+
+# One function per step, reading the previous step's file: used by run_one /
+# run_downstream and by the single-step commands (`pipeline.py structure` ...).
+
+def _extract_step(
+    input_json: Path,
+    paths: dict[str, Path],
+    args: argparse.Namespace,
+    retry_queue: RetryQueue | None = None,
+    on_row=None,
+) -> Path:
+    # ---- Step 1: Extract ----
+    _log(f"[{input_json.stem}] Step 1/5: Extract (LLM) -> {paths['summary'].name}")
+    run_extract(
+        input_json_path=input_json,
+        output_summary_csv_path=paths["summary"],
+        model=args.extract_model,
+        sleep_s=args.extract_sleep,
+        fast_model=args.extract_fast_model,
+        retry_queue=retry_queue,
+        on_row=on_row,
+    )
+    _ensure_exists(paths["summary"], "Summary CSV")
+    return paths["summary"]
 
-    smiles_list = []
-    for name in names:
-        key = (role, str(name).strip())
-        smiles_list.append(smiles_map.get(key, "Not Found"))
 
-    return ", ".join(smiles_list)
+def _structure_step(input_json: Path, paths: dict[str, Path], args: argparse.Namespace, retry_queue=None) -> Path:
+    from structure_step import run_structure
 
+    # ---- Step 2: Structure ----
+    _log(f"[{input_json.stem}] Step 2/5: Structure -> {paths['table'].name}")
+    _ensure_exists(paths["summary"], "Summary CSV")
+    run_structure(
+        input_summary_csv=str(paths["summary"]),
+        output_table_csv=str(paths["table"]),
+    )
+    _ensure_exists(paths["table"], "Table CSV")
+    return paths["table"]
 
-def build_index_title_map(input_json_path):
-    import json
-    from pathlib import Path
 
-    with Path(input_json_path).open("r", encoding="utf-8") as f:
-        data = json.load(f)
+def _time_step(input_json: Path, paths: dict[str, Path], args: argparse.Namespace, retry_queue=None) -> Path:
+    from time_step import run_time_standardize
 
-    index_title_map = {}
+    # ---- Step 3: Time standardize ----
+    _log(f"[{input_json.stem}] Step 3/5: Time standardize -> {paths['timetable'].name}")
+    _ensure_exists(paths["table"], "Table CSV")
+    run_time_standardize(
+        input_table_csv=str(paths["table"]),
+        output_timetable_csv=str(paths["timetable"]),
+        model=args.time_model,
+        delay=args.time_delay,
+    )
+    _ensure_exists(paths["timetable"], "Timetable CSV")
+    return paths["timetable"]
 
-    for reaction_key, payload in data.items():
-        title = payload.get("Title", "")
-        procedures = payload.get("Procedure", [])
 
-        if isinstance(procedures, str):
-            procedures = [procedures]
+def _smiles_step(
+    input_json: Path,
+    paths: dict[str, Path],
+    args: argparse.Namespace,
+    retry_queue: RetryQueue | None = None,
+) -> Path:
+    from smiles_step import run_smiles_lookup
 
-        # Step 1 output index = reaction_key_1
-        for proc_idx in range(1, len(procedures) + 1):
-            base_index = f"{reaction_key}_{proc_idx}"
+    tag = input_json.stem
+    # ---- Step 4: SMILES lookup ----
+    _log(f"[{tag}] Step 4/5: SMILES lookup -> {paths['smiles'].name}")
+    _ensure_exists(paths["table"], "Table CSV")
+    run_smiles_lookup(
+        input_table_csv=str(paths["table"]),
+        output_smiles_csv=str(paths["smiles"]),
+        model=args.smiles_model,
+        retry_queue=retry_queue,
+    )
+    _ensure_exists(paths["smiles"], "SMILES lookup CSV")
+    if retry_queue is not None and len(retry_queue):
+        _log(f"[{tag}] {len(retry_queue)} failed item(s) queued in {paths['retry'].name} (pipeline.py retry)")
+    return paths["smiles"]
 
-            # Step 2 creates rows like base_index_1, base_index_2...
-            # On ne sait pas combien il y aura de lignes,
-            # donc on va mapper dynamiquement plus tard.
-            index_title_map[base_index] = title
 
-    return index_title_map
+def _final_step(input_json: Path, paths: dict[str, Path], args: argparse.Namespace, retry_queue=None) -> Path:
+    """Merge, then record the fingerprints of the procedures the outputs now cover."""
+    final = _merge_step(input_json, paths, args)
+    write_fingerprints(input_json, paths)
+    return final
 
 
-def merge_final(
-    table_csv: Path,
-    timetable_csv: Path,
-    smiles_lookup_csv: Path,
-    output_final_csv: Path, index_title_map
-) -> Path:
-    _log("Merging final outputs...")
-
-    table_df = pd.read_csv(table_csv)
-    time_df = pd.read_csv(timetable_csv)
-    smiles_df = pd.read_csv(smiles_lookup_csv)
-
-    # --- Merge time (minutes) ---
-    if "Index" not in table_df.columns:
-        raise ValueError("table.csv must contain 'Index' column.")
-    if "Index" not in time_df.columns or "Reaction time" not in time_df.columns:
-        raise ValueError("timetable.csv must contain ['Index', 'Reaction time'].")
-
-    merged = table_df.merge(
-        time_df[["Index", "Reaction time"]].rename(columns={"Reaction time": "Reaction time (minutes)"}),
-        on="Index",
-        how="left",
-    )
-    # --- Add Title column ---
-    merged["Title"] = merged["Index"].apply(
-    lambda x: index_title_map.get(
-        "_".join(x.split("_")[:2]),  # pbfa_1 from pbfa_1_1
-        ""
+def _merge_step(input_json: Path, paths: dict[str, Path], args: argparse.Namespace) -> Path:
+    from merge_step import build_index_title_map, merge_final
+
+    tag = input_json.stem
+    index_title_map = build_index_title_map(input_json)
+    # ---- Step 5: Merge final ----
+    _log(f"[{tag}] Step 5/5: Merge final -> {paths['final'].name}")
+    merge_final(
+        table_csv=paths["table"],
+        timetable_csv=paths["timetable"],
+        smiles_lookup_csv=paths["smiles"],
+        output_final_csv=paths["final"],
+        index_title_map=index_title_map,
+        chunk_rows=args.merge_chunk_rows,
+        registry=open_registry(paths["molecules"]) if args.molecule_ids != "off" else None,
+        drop_smiles=args.molecule_ids == "replace",
     )
-)
+    return paths["final"]
 
-    # --- Build smiles map and add columns ---
-    smiles_map = _build_smiles_map(smiles_df)
 
-    # Ensure columns exist in table
-    if "Reactants" not in merged.columns:
-        merged["Reactants"] = ""
-    if "Products" not in merged.columns:
-        merged["Products"] = ""
+def _procedure_order(input_json: Path) -> dict[str, int]:
+    with input_json.open("r", encoding="utf-8") as f:
+        return {idx: i for i, (idx, _, _) in enumerate(iter_procedures(json.load(f)))}
 
-    merged["Reactants_SMILES"] = merged["Reactants"].apply(
-        lambda x: _smiles_for_cell(x, "Reactant", smiles_map)
-    )
-    merged["Products_SMILES"] = merged["Products"].apply(
-        lambda x: _smiles_for_cell(x, "Product", smiles_map)
+
+def _patch_summary(summary_csv: Path, summaries: dict[str, str], order: dict[str, int], drop=()) -> None:
+    """Add / replace / drop rows of *_summary.csv, keeping the input JSON order."""
+    import pandas as pd
+
+    old = (
+        pd.read_csv(summary_csv, dtype=str, keep_default_na=False)
+        if summary_csv.exists()
+        else pd.DataFrame(columns=["Index", "Summary"])
     )
+    new = pd.DataFrame(list(summaries.items()), columns=["Index", "Summary"])
+    gone = set(summaries) | set(drop)
+    out = pd.concat([old[~old["Index"].isin(gone)], new], ignore_index=True)
+    out = out.sort_values("Index", key=lambda s: s.map(order), kind="stable")
+    out.to_csv(summary_csv, index=False)
+
+
+def refresh_outputs(
+    input_json: Path,
+    paths: dict[str, Path],
+    args: argparse.Namespace,
+    summaries: dict[str, str],
+    smiles_traces: dict[str, dict] | None = None,
+    retry_queue: RetryQueue | None = None,
+    drop=(),
+) -> Path:
+    """
+    Fold new extract summaries ({Index: summary}) and SMILES traces
+    ({name: trace}) into existing outputs, and remove the procedures in
+    `drop`. Only the new table rows get a time-standardization call and only
+    new names a SMILES lookup; the final merge is re-run (no API calls).
+    """
+    import pandas as pd
+    from structure_step import patch_table, procedure_of, run_structure
+    from time_step import patch_timetable, run_time_standardize
+    from smiles_step import patch_smiles_lookup, run_smiles_lookup
+
+    tag = input_json.stem
+    order = _procedure_order(input_json)
+    if summaries or drop:
+        _patch_summary(paths["summary"], summaries, order, drop)
+        _log(f"[{tag}] Summary: {len(summaries)} procedure(s) updated, {len(drop)} dropped")
+
+    if paths["table"].exists():
+        new = pd.DataFrame(list(summaries.items()), columns=["Index", "Summary"])
+        n = patch_table(new, str(paths["table"]), order, drop)
+        _log(f"[{tag}] Table: {n} row(s) added")
+    else:
+        run_structure(input_summary_csv=str(paths["summary"]), output_table_csv=str(paths["table"]))
+
+    if paths["timetable"].exists():
+        table_index = pd.read_csv(paths["table"], usecols=["Index"])["Index"].astype(str)
+        refresh = set(table_index[procedure_of(table_index).isin(summaries)])
+        n = patch_timetable(str(paths["table"]), str(paths["timetable"]), model=args.time_model, refresh=refresh)
+        _log(f"[{tag}] Timetable: {n} row(s) standardized")
+    else:
+        run_time_standardize(str(paths["table"]), str(paths["timetable"]), model=args.time_model, delay=0)
+
+    if paths["smiles"].exists():
+        n = patch_smiles_lookup(
+            str(paths["table"]), str(paths["smiles"]),
+            model=args.smiles_model, traces=smiles_traces, retry_queue=retry_queue,
+        )
+        _log(f"[{tag}] SMILES lookup: {n} name(s) resolved")
+    else:
+        run_smiles_lookup(str(paths["table"]), str(paths["smiles"]), model=args.smiles_model, retry_queue=retry_queue)
+
+    return _final_step(input_json, paths, args)
+
+
+def procedure_fingerprints(input_json: Path) -> dict[str, str]:
+    """{Index: sha1 of (Title, Procedure)} for every procedure of the input JSON."""
+    with input_json.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {
+        idx: hashlib.sha1(json.dumps([title, proc], ensure_ascii=False).encode("utf-8")).hexdigest()
+        for idx, title, proc in iter_procedures(data)
+    }
+
 
-    # Optional: overwrite original Reaction time with standardized minutes if you want
-    # Here we KEEP original + add standardized column.
-    # If you prefer replacing:
-    # merged["Reaction time"] = merged["Reaction time (minutes)"].fillna(merged.get("Reaction time"))
-    cols = list(merged.columns)
-    if "Title" in cols:
-        cols.insert(1, cols.pop(cols.index("Title")))
-        merged = merged[cols]
-    output_final_csv.parent.mkdir(parents=True, exist_ok=True)
-    merged.to_csv(output_final_csv, index=False)
+def write_fingerprints(input_json: Path, paths: dict[str, Path]) -> None:
+    """
+    Fingerprints of the procedures that have a summary (failed ones stay
+    "new" for the next incremental run).
+    """
+    import pandas as pd
 
-    _log(f"Final CSV written: {output_final_csv}")
-    return output_final_csv
+    done = set(pd.read_csv(paths["summary"], usecols=["Index"], dtype=str)["Index"])
+    current = procedure_fingerprints(input_json)
+    tmp = paths["fingerprints"].with_suffix(".json.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump({idx: fp for idx, fp in current.items() if idx in done}, f, indent=1)
+    os.replace(tmp, paths["fingerprints"])
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Organic reaction extraction pipeline")
-    parser.add_argument("input_json", help="Path to input JSON, e.g. data/input_test.json")
+def run_incremental(input_json: Path, paths: dict[str, Path], args: argparse.Namespace) -> Path:
+    """
+    Delta run against the outputs of a previous run: only new or changed
+    procedures are extracted, removed ones are dropped, and the artifacts are
+    patched in place. Falls back to a full run when there is nothing to
+    compare with.
+    """
+    tag = input_json.stem
+    if not (paths["fingerprints"].exists() and paths["summary"].exists()):
+        _log(f"[{tag}] No previous fingerprints: full run")
+        return run_one(input_json, paths, args)
+
+    with paths["fingerprints"].open("r", encoding="utf-8") as f:
+        previous: dict[str, str] = json.load(f)
+    current = procedure_fingerprints(input_json)
+    changed = [idx for idx, fp in current.items() if previous.get(idx) != fp]
+    removed = [idx for idx in previous if idx not in current]
+    _log(f"[{tag}] Incremental: {len(changed)} new/changed, {len(removed)} removed, "
+         f"{len(current) - len(changed)} unchanged procedure(s)")
+
+    retry_queue = open_retry_queue(paths)
+    retry_queue.set_outputs(paths)
+    for idx in removed:
+        retry_queue.resolve("extract", idx)
+
+    with input_json.open("r", encoding="utf-8") as f:
+        todo = [item for item in iter_procedures(json.load(f)) if item[0] in set(changed)]
+    _log(f"[{tag}] Step 1/5: Extract (LLM) {len(todo)} procedure(s)")
+    prefetch = _name_prefetcher(args)
+    try:
+        summaries = timed_stage("extract")(extract_procedures)(
+            todo,
+            model=args.extract_model,
+            sleep_s=args.extract_sleep,
+            fast_model=args.extract_fast_model,
+            retry_queue=retry_queue,
+            on_row=prefetch.add_row if prefetch else None,
+        )
+    finally:
+        if prefetch:
+            prefetch.close()
+    # a changed procedure that failed keeps no stale summary
+    drop = set(removed) | (set(changed) - set(summaries))
+    return refresh_outputs(input_json, paths, args, summaries, retry_queue=retry_queue, drop=drop)
+
+
+def _log_stage_summary() -> None:
+    report = METRICS.report()
+    for stage, st in report["stages"].items():
+        _log(f"  {stage:<10} {st['wall_seconds']:>10.2f} s  ({st['calls']} call(s))")
+
+
+def _escalation_report(fast_model: str, model: str) -> dict:
+    """
+    Escalation rate of the small-model-first extract mode and an estimate of
+    the latency saved: accepted fast answers x (mean large - mean fast latency).
+    Without escalations the large-model latency comes from its calls in other
+    stages (per-model latency histogram); with no sample at all the estimate
+    is unavailable (None).
+    """
+    accepted = int(METRICS.counter_value("extract_fast_accepted_total"))
+    reasons: dict[str, int] = {}
+    for labels, value in METRICS.counter_series("extract_escalations_total"):
+        reasons[labels["reason"]] = reasons.get(labels["reason"], 0) + int(value)
+    escalated = sum(reasons.values())
+    total = accepted + escalated
+
+    fast = METRICS.histogram_stats("extract_attempt_latency_seconds", tier="fast")
+    large = METRICS.histogram_stats("extract_attempt_latency_seconds", tier="large")
+    fast_mean = fast["mean"] if fast else None
+    large_mean = large["mean"] if large else None
+    large_source = "extract" if large_mean is not None else None
+    if large_mean is None:
+        other = METRICS.histogram_stats("llm_call_latency_seconds", model=model)
+        if other and other["mean"] is not None:
+            large_mean, large_source = other["mean"], "other_stages"
+    saved = None
+    if fast_mean is not None and large_mean is not None:
+        saved = round(accepted * (large_mean - fast_mean), 3)
+
+    return {
+        "fast_model": fast_model,
+        "model": model,
+        "procedures": total,
+        "accepted_fast": accepted,
+        "escalated": escalated,
+        "escalation_rate": round(escalated / total, 4) if total else None,
+        "reasons": reasons,
+        "fast_latency_mean_s": fast_mean,
+        "large_latency_mean_s": large_mean,
+        "large_latency_source": large_source,
+        "estimated_latency_saved_s": saved,
+    }
+
+
+def _log_budget_summary() -> None:
+    report = BUDGET.report()
+    _log(f"LLM spend: {report['spent_tokens']} tokens, ~${report['spent_usd']:.4f}")
+    for stage, st in report["per_stage"].items():
+        refused = f", {st['refused']} refused" if st["refused"] else ""
+        _log(
+            f"  {stage:<10} {st['prompt_tokens'] + st['completion_tokens']:>10} tokens"
+            f"  ~${st['usd']:.4f}  ({st['calls']} call(s){refused})"
+        )
+
+
+def _run_all(inputs: list[Path], output_dir: Path, batch: bool, jobs: int, args: argparse.Namespace) -> None:
+    jobs_list = [(p, output_paths(output_dir, p.stem, batch)) for p in inputs]
+    failures: list[tuple[Path, Exception]] = []
+    run = run_incremental if args.incremental else run_one
+
+    if jobs == 1 or not batch:
+        for input_json, paths in jobs_list:
+            try:
+                run(input_json, paths, args)
+            except Exception as e:
+                if not batch:
+                    raise
+                _log(f"[{input_json.stem}] FAILED: {e}")
+                failures.append((input_json, e))
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(run, p, paths, args): p for p, paths in jobs_list}
+            for fut in as_completed(futures):
+                input_json = futures[fut]
+                try:
+                    fut.result()
+                except Exception as e:
+                    _log(f"[{input_json.stem}] FAILED: {e}")
+                    failures.append((input_json, e))
+
+    if failures:
+        names = ", ".join(p.name for p, _ in failures)
+        raise RuntimeError(f"{len(failures)}/{len(inputs)} input(s) failed: {names}")
+
+
+def _add_run_args(parser: argparse.ArgumentParser) -> None:
+    """Options shared by every command (models, budget, PubChem, metrics)."""
     parser.add_argument(
         "--output-dir",
         default=None,
         help="Output directory (default: <project_root>/outputs)",
     )
     parser.add_argument("--model", default="gpt-4o-mini", help="OpenAI model name")
+    parser.add_argument("--extract-model", default=None, help="Model for the extract step (default: --model)")
+    parser.add_argument("--time-model", default=None, help="Model for time standardization (default: --model)")
+    parser.add_argument("--smiles-model", default=None, help="Model for SMILES name fallbacks (default: --model)")
+    parser.add_argument(
+        "--extract-fast-model",
+        default=None,
+        help="Try this model first for each procedure and escalate to --extract-model only when its table fails validation",
+    )
     parser.add_argument("--extract-sleep", type=float, default=2.0, help="Sleep seconds between extract calls")
     parser.add_argument("--time-delay", type=float, default=2.0, help="Delay before time standardization call")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Global cap on concurrent API calls (OpenAI + PubChem) across all files (default: --jobs)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Run report path (default: <output_dir>/run_metrics.json)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Expose Prometheus-style counters on http://HOST:PORT/metrics during the run",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default=DEFAULT_METRICS_HOST,
+        help="Interface of the metrics endpoint (default: %(default)s; 0.0.0.0 = every interface)",
+    )
+    parser.add_argument(
+        "--pubchem-backend",
+        choices=PUBCHEM_BACKENDS,
+        default="compound",
+        help="compound: full record per name; batch: name->CID then bulk CID->SMILES",
+    )
+    parser.add_argument("--pubchem-rate", type=float, default=5.0, help="Max PubChem requests per second (0 = no limit)")
+    parser.add_argument("--max-run-tokens", type=int, default=None, help="Token budget (prompt + completion) for the run")
+    parser.add_argument("--max-tokens-per-min", type=int, default=None, help="Token budget per rolling minute")
+    parser.add_argument("--max-cost-usd", type=float, default=None, help="Estimated spend cap for the run (USD)")
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=None,
+        help="Send a duplicate LLM request when a call is slower than this percentile of observed latency, e.g. 95 (default: off)",
+    )
+    parser.add_argument(
+        "--hedge-max-fraction",
+        type=float,
+        default=0.1,
+        help="At most this share of LLM calls may be hedged (caps the extra spend)",
+    )
+    parser.add_argument(
+        "--hedge-min-samples",
+        type=int,
+        default=20,
+        help="Calls observed per stage/model before hedging starts",
+    )
+    parser.add_argument(
+        "--merge-chunk-rows",
+        type=int,
+        default=0,
+        help="Stream the table in chunks of N rows during the final merge (bounded memory, same output; 0 = off)",
+    )
+    parser.add_argument(
+        "--molecule-ids",
+        choices=("add", "replace", "off"),
+        default="add",
+        help="MolID columns in the final CSV (registry: <output_dir>/molecules.csv): "
+             "add them, replace the SMILES columns with them, or off",
+    )
+    parser.add_argument(
+        "--budget-reserve",
+        type=float,
+        default=0.2,
+        help="Share of each budget kept for extract/time calls; LLM name fallbacks stop once it is reached",
+    )
 
-    args = parser.parse_args()
 
+def _resolve_output_dir(args: argparse.Namespace) -> Path:
     # Project root assumed: src/ is alongside data/ and outputs/
     src_dir = Path(__file__).resolve().parent
     project_root = src_dir.parent
+    output_dir = Path(args.output_dir).resolve() if args.output_dir else (project_root / "outputs")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return output_dir
 
-    input_json = Path(args.input_json).resolve()
-    _ensure_exists(input_json, "Input JSON")
 
-    if not os.getenv("OPENAI_API_KEY"):
+def _configure_run(
+    args: argparse.Namespace,
+    default_concurrency: int,
+    needs_api: bool = True,
+    pubchem: bool = True,
+) -> None:
+    """
+    Apply per-stage models, API limits, budget and metrics for this process.
+    needs_api=False: no OpenAI key required (structure, merge); pubchem=False:
+    the SMILES step (and its imports) is not used by the command.
+    """
+    if needs_api and not os.getenv("OPENAI_API_KEY"):
         raise RuntimeError("OPENAI_API_KEY is not set in environment variables.")
 
-    output_dir = Path(args.output_dir).resolve() if args.output_dir else (project_root / "outputs")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    args.extract_model = args.extract_model or args.model
+    args.time_model = args.time_model or args.model
+    args.smiles_model = args.smiles_model or args.model
 
-    stem = input_json.stem  # input_test
-    summary_csv = output_dir / f"{stem}_summary.csv"
-    table_csv = output_dir / f"{stem}_table.csv"
-    timetable_csv = output_dir / f"{stem}_timetable.csv"
-    smiles_csv = output_dir / "smiles_lookup.csv"
-    final_csv = output_dir / "final_output.csv"
+    set_max_concurrency(args.max_concurrency if args.max_concurrency is not None else default_concurrency)
+    if pubchem:
+        from smiles_step import set_pubchem_backend
 
-    _log(f"Input: {input_json}")
-    _log(f"Outputs dir: {output_dir}")
-    _log(f"Model: {args.model}")
+        set_pubchem_backend(args.pubchem_backend)
+    PUBCHEM_LIMITER.set_rate(args.pubchem_rate)
 
-    # ---- Step 1: Extract ----
-    _log("Step 1/5: Extract (LLM) -> summary.csv")
-    run_extract(
-        input_json_path=input_json,
-        output_summary_csv_path=summary_csv,
-        model=args.model,
-        sleep_s=args.extract_sleep,
+    METRICS.reset()
+    BUDGET.configure(
+        max_run_tokens=args.max_run_tokens,
+        max_tokens_per_min=args.max_tokens_per_min,
+        max_cost_usd=args.max_cost_usd,
+        reserve=args.budget_reserve,
     )
-    _ensure_exists(summary_csv, "Summary CSV")
+    HEDGING.configure(
+        percentile=args.hedge_percentile,
+        max_fraction=args.hedge_max_fraction,
+        min_samples=args.hedge_min_samples,
+    )
+    if args.metrics_port:
+        serve_prometheus(args.metrics_port, args.metrics_host)
+        _log(f"Prometheus metrics: http://{args.metrics_host}:{args.metrics_port}/metrics")
+
+
+def _log_models(args: argparse.Namespace) -> None:
+    if args.extract_fast_model:
+        _log(f"Models: extract={args.extract_fast_model} -> {args.extract_model} (escalation), "
+             f"time={args.time_model}, smiles={args.smiles_model}")
+    else:
+        _log(f"Models: extract={args.extract_model}, time={args.time_model}, smiles={args.smiles_model}")
+    if args.molecule_ids != "off":
+        _log(f"Molecule IDs: {args.molecule_ids} (canonical SMILES: {canonicalizer()})")
+
+
+def _write_run_report(args: argparse.Namespace, metrics_file: Path) -> None:
+    extra = {"budget": BUDGET.report()}
+    if args.extract_fast_model:
+        extra["escalation"] = _escalation_report(args.extract_fast_model, args.extract_model)
+    if HEDGING.enabled:
+        extra["hedging"] = HEDGING.report()
+    METRICS.write_json(metrics_file, extra=extra)
+    _log(f"Run metrics written: {metrics_file}")
+    _log_stage_summary()
+    _log_budget_summary()
+    if "escalation" in extra:
+        esc = extra["escalation"]
+        saved = esc["estimated_latency_saved_s"]
+        _log(
+            f"Escalation: {esc['escalated']}/{esc['procedures']} procedure(s) re-run on {esc['model']}"
+            f" (rate {esc['escalation_rate']}), est. latency saved "
+            + (f"{saved} s" if saved is not None else f"n/a (no {esc['model']} latency sample)")
+        )
+    if "hedging" in extra:
+        hedge = extra["hedging"]
+        _log(f"Hedging: {hedge['hedged']}/{hedge['calls']} LLM call(s) hedged (rate {hedge['hedge_rate']}), {hedge['hedge_wins']} won")
+        for stage, st in hedge["per_stage"].items():
+            if st["p50_s"] is not None:
+                _log(
+                    f"  {stage:<10} p50 {st['p50_s']:.3f} s  p99 {st['p99_s']:.3f} s"
+                    f"  ({st['hedged']} hedged, ~{st['extra_tokens_est']} extra tokens)"
+                )
+
+
+def _cmd_all(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Organic reaction extraction pipeline",
+        epilog="Other commands: " + ", ".join(c for c in COMMANDS if c != "all")
+        + " (pipeline.py <command> --help). `pipeline.py all ...` is the same as `pipeline.py ...`.",
+    )
+    parser.add_argument(
+        "input_json",
+        nargs="+",
+        help="Input JSON file(s), directories or glob patterns, e.g. data/input_test.json or 'data/*.json'",
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="Number of input files processed in parallel")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only extract new or changed procedures and patch the previous outputs (full run if there are none)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream extract answers and start resolving compound names as soon as each table row arrives",
+    )
+    _add_run_args(parser)
+    args = parser.parse_args(argv)
 
-    # ---- Step 2: Structure ----
-    _log("Step 2/5: Structure -> table.csv")
-    run_structure(
-        input_summary_csv=str(summary_csv),
-        output_table_csv=str(table_csv),
+    from smiles_step import PREFETCH_WORKERS
+
+    inputs = collect_inputs(args.input_json)
+    jobs = max(1, args.jobs)
+    # --stream: leave room for the name lookups that run alongside extraction
+    _configure_run(args, default_concurrency=jobs * (1 + PREFETCH_WORKERS) if args.stream else jobs)
+    output_dir = _resolve_output_dir(args)
+
+    # Single input keeps the historical smiles_lookup.csv / final_output.csv names
+    batch = len(inputs) > 1
+
+    _log(f"Inputs: {len(inputs)} file(s)" if batch else f"Input: {inputs[0]}")
+    _log(f"Outputs dir: {output_dir}")
+    _log_models(args)
+    if batch:
+        _log(f"Jobs: {jobs}")
+
+    metrics_file = Path(args.metrics_file).resolve() if args.metrics_file else (output_dir / "run_metrics.json")
+    try:
+        _run_all(inputs, output_dir, batch, jobs, args)
+    finally:
+        _write_run_report(args, metrics_file)
+
+    _log("DONE ✅")
+
+
+def _worker_process(queue_path: str, args: argparse.Namespace, metrics_file: str) -> None:
+    """Entry point of one worker process (must be importable for spawn)."""
+    _configure_run(args, default_concurrency=0, pubchem=False)
+    try:
+        stats = run_worker(
+            queue_path,
+            model=args.extract_model,
+            fast_model=args.extract_fast_model,
+            batch_size=args.batch_size,
+            lease_s=args.lease_seconds,
+            max_attempts=args.max_attempts,
+            sleep_s=args.extract_sleep,
+        )
+        _log(f"worker {os.getpid()}: {stats['done']} done, {stats['failed']} failed attempt(s)")
+    finally:
+        METRICS.write_json(metrics_file, extra={"budget": BUDGET.report()})
+
+
+def _cmd_worker(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="pipeline.py worker",
+        description="Extract procedures from a shared SQLite work queue (run on as many processes / machines as needed)",
+    )
+    parser.add_argument("input_json", nargs="*", help="Input JSON file(s) to add to the queue (idempotent)")
+    parser.add_argument("--queue", required=True, help="SQLite queue file shared by all workers")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to start on this machine")
+    parser.add_argument("--batch-size", type=int, default=4, help="Procedures leased per claim")
+    parser.add_argument("--lease-seconds", type=float, default=600.0, help="Lease duration before a procedure can be reclaimed")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Attempts before a procedure is marked failed")
+    _add_run_args(parser)
+    args = parser.parse_args(argv)
+
+    queue_path = Path(args.queue).resolve()
+    with WorkQueue(queue_path) as q:
+        for input_json in collect_inputs(args.input_json) if args.input_json else []:
+            added = q.seed(input_json)
+            _log(f"Queue: +{added} procedure(s) from {input_json.name}")
+        _log(f"Queue {queue_path.name}: {q.counts()}")
+
+    metrics_dir = queue_path.parent
+    if args.processes <= 1:
+        _worker_process(str(queue_path), args, str(metrics_dir / f"{queue_path.stem}_worker_{os.getpid()}_metrics.json"))
+    else:
+        import multiprocessing
+
+        procs = []
+        for i in range(args.processes):
+            metrics_file = metrics_dir / f"{queue_path.stem}_worker_{os.getpid()}_{i}_metrics.json"
+            worker_args = argparse.Namespace(**vars(args))
+            if args.metrics_port:
+                # one endpoint per process (each has its own counters)
+                worker_args.metrics_port = args.metrics_port + i
+            p = multiprocessing.Process(target=_worker_process, args=(str(queue_path), worker_args, str(metrics_file)))
+            p.start()
+            procs.append(p)
+        for p in procs:
+            p.join()
+
+    with WorkQueue(queue_path) as q:
+        _log(f"Queue {queue_path.name}: {q.counts()}")
+
+
+def _cmd_reduce(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="pipeline.py reduce",
+        description="Export the queue results as *_summary.csv and run structure, time, SMILES and merge",
+    )
+    parser.add_argument("input_json", help="Input JSON the queue was seeded with (titles, output names)")
+    parser.add_argument("--queue", required=True, help="SQLite queue file")
+    parser.add_argument(
+        "--allow-incomplete",
+        action="store_true",
+        help="Reduce even if procedures are still pending or leased",
     )
-    _ensure_exists(table_csv, "Table CSV")
+    _add_run_args(parser)
+    args = parser.parse_args(argv)
 
-    # ---- Step 3: Time standardize ----
-    _log("Step 3/5: Time standardize -> timetable.csv")
-    run_time_standardize(
-        input_table_csv=str(table_csv),
-        output_timetable_csv=str(timetable_csv),
-        model=args.model,
-        delay=args.time_delay,
+    input_json = Path(args.input_json).resolve()
+    _ensure_exists(input_json, "Input JSON")
+    _configure_run(args, default_concurrency=1)
+    output_dir = _resolve_output_dir(args)
+    paths = output_paths(output_dir, input_json.stem, per_input_names=False)
+
+    queue_path = Path(args.queue).resolve()
+    _ensure_exists(queue_path, "Queue")
+    name = input_name(input_json)
+    with WorkQueue(queue_path) as q:
+        counts = q.counts(name)
+        _log(f"Queue ({name}): {counts}")
+        if not any(counts.values()):
+            raise RuntimeError(f"No procedure of {input_json.name} in {queue_path.name}; seed it with `pipeline.py worker`.")
+        if (counts["pending"] or counts["leased"]) and not args.allow_incomplete:
+            raise RuntimeError("Queue not drained (pending/leased procedures left); use --allow-incomplete to reduce anyway.")
+        q.export_summary(name, paths["summary"])
+        unfinished = q.unfinished(name)
+    _log(f"Summary exported: {paths['summary']}")
+    _log_models(args)
+
+    retry_queue = open_retry_queue(paths)
+    retry_queue.set_outputs(paths)
+    for idx, status, error in unfinished:
+        retry_queue.add("extract", idx, error or f"Unfinished: {status}")
+
+    metrics_file = Path(args.metrics_file).resolve() if args.metrics_file else (output_dir / "run_metrics.json")
+    try:
+        run_downstream(input_json, paths, args, retry_queue)
+    finally:
+        _write_run_report(args, metrics_file)
+
+    _log("DONE ✅")
+
+
+def _cmd_retry(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="pipeline.py retry",
+        description="Re-run only the failed items of a previous run and merge them into its outputs",
     )
-    _ensure_exists(timetable_csv, "Timetable CSV")
+    parser.add_argument("input_json", help="Input JSON of the run")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Attempts (all runs included) before an item is dead-lettered")
+    parser.add_argument("--retry-workers", type=int, default=4, help="Items retried concurrently")
+    parser.add_argument("--retry-backoff", type=float, default=2.0, help="First backoff delay in seconds (doubles per attempt)")
+    _add_run_args(parser)
+    args = parser.parse_args(argv)
 
-    # ---- Step 4: SMILES lookup ----
-    _log("Step 4/5: SMILES lookup -> smiles_lookup.csv")
-    run_smiles_lookup(
-        input_table_csv=str(table_csv),
-        output_smiles_csv=str(smiles_csv),
-        model=args.model,
+    from smiles_step import get_smiles_with_trace, trace_errors
+
+    input_json = Path(args.input_json).resolve()
+    _ensure_exists(input_json, "Input JSON")
+    _configure_run(args, default_concurrency=args.retry_workers)
+    output_dir = _resolve_output_dir(args)
+    paths = output_paths(output_dir, input_json.stem, per_input_names=False)
+    _ensure_exists(paths["retry"], "Retry queue")
+    retry_queue = open_retry_queue(paths)
+    # batch runs use prefixed names: patch the files the run actually wrote
+    paths.update({k: Path(v) for k, v in retry_queue.outputs.items()})
+
+    extract_items = retry_queue.items("extract")
+    smiles_items = retry_queue.items("smiles")
+    _log(f"Retry queue: {len(extract_items)} procedure(s), {len(smiles_items)} name(s)")
+    if not extract_items and not smiles_items:
+        _log("Nothing to retry.")
+        return
+    _log_models(args)
+
+    with input_json.open("r", encoding="utf-8") as f:
+        procedures = {idx: (title, proc) for idx, title, proc in iter_procedures(json.load(f))}
+    for item in extract_items:
+        if item["key"] not in procedures:
+            _log(f"  {item['key']}: no longer in the input, dropped")
+            retry_queue.resolve("extract", item["key"])
+    extract_items = [it for it in extract_items if it["key"] in procedures]
+
+    def extract(item: dict) -> str:
+        title, proc = procedures[item["key"]]
+        return extract_one(title, proc, model=args.extract_model, fast_model=args.extract_fast_model)
+
+    def lookup(item: dict) -> dict:
+        trace = get_smiles_with_trace(item["key"], model=args.smiles_model)
+        errors = trace_errors(trace)
+        if errors:
+            raise StepError(errors[0])
+        return trace
+
+    metrics_file = Path(args.metrics_file).resolve() if args.metrics_file else (output_dir / "run_metrics.json")
+    try:
+        opts = dict(max_attempts=args.max_attempts, backoff_s=args.retry_backoff, workers=args.retry_workers)
+        summaries = retry_items(retry_queue, extract_items, extract, **opts)
+        traces = retry_items(retry_queue, smiles_items, lookup, **opts)
+        dead = int(METRICS.counter_value("retry_queue_dead_lettered_total"))
+        _log(
+            f"Recovered {len(summaries)}/{len(extract_items)} procedure(s), {len(traces)}/{len(smiles_items)} name(s);"
+            f" {dead} dead-lettered -> {paths['dead_letter'].name}"
+        )
+        if summaries or traces:
+            refresh_outputs(input_json, paths, args, summaries, traces, retry_queue)
+    finally:
+        _write_run_report(args, metrics_file)
+
+    _log("DONE ✅")
+
+
+# step command -> (step function, help, needs an OpenAI key, uses the SMILES step)
+STEP_COMMANDS = {
+    "extract": (_extract_step, "Step 1: input JSON -> *_summary.csv (LLM)", True, False),
+    "structure": (_structure_step, "Step 2: *_summary.csv -> *_table.csv", False, False),
+    "time": (_time_step, "Step 3: *_table.csv -> *_timetable.csv (LLM)", True, False),
+    "smiles": (_smiles_step, "Step 4: *_table.csv -> smiles_lookup.csv (PubChem / OPSIN / LLM)", True, True),
+    "merge": (_final_step, "Step 5: table + timetable + SMILES lookup -> final_output.csv", False, False),
+}
+
+
+def _cmd_step(step: str, argv: list[str]) -> None:
+    """Run one step for each input, from the files of the previous steps."""
+    run, description, needs_api, pubchem = STEP_COMMANDS[step]
+    parser = argparse.ArgumentParser(prog=f"pipeline.py {step}", description=description)
+    parser.add_argument(
+        "input_json",
+        nargs="+",
+        help="Input JSON file(s), directories or glob patterns of the run (output names, titles)",
     )
-    _ensure_exists(smiles_csv, "SMILES lookup CSV")
-    index_title_map = build_index_title_map(input_json)
-    # ---- Step 5: Merge final ----
-    _log("Step 5/5: Merge final -> final_output.csv")
-    merge_final(
-    table_csv=table_csv,
-    timetable_csv=timetable_csv,
-    smiles_lookup_csv=smiles_csv,
-    output_final_csv=final_csv,
-    index_title_map=index_title_map
-)
+    _add_run_args(parser)
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.input_json)
+    _configure_run(args, default_concurrency=1, needs_api=needs_api, pubchem=pubchem)
+    output_dir = _resolve_output_dir(args)
+    batch = len(inputs) > 1
+    if needs_api:
+        _log_models(args)
+
+    metrics_file = Path(args.metrics_file).resolve() if args.metrics_file else (output_dir / "run_metrics.json")
+    try:
+        for input_json in inputs:
+            paths = output_paths(output_dir, input_json.stem, batch)
+            retry_queue = None
+            if paths["retry"].exists():
+                retry_queue = open_retry_queue(paths)
+                # a batch run used prefixed names: use the files it actually wrote
+                paths.update({k: Path(v) for k, v in retry_queue.outputs.items()})
+            if step in ("extract", "smiles"):
+                retry_queue = retry_queue or open_retry_queue(paths)
+                retry_queue.set_outputs(paths)
+            run(input_json, paths, args, retry_queue)
+    finally:
+        _write_run_report(args, metrics_file)
 
     _log("DONE ✅")
 
 
+COMMANDS = {
+    "all": _cmd_all,
+    **{step: functools.partial(_cmd_step, step) for step in STEP_COMMANDS},
+    "worker": _cmd_worker,
+    "reduce": _cmd_reduce,
+    "retry": _cmd_retry,
+}
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return _cmd_all(argv)
+
+
 if __name__ == "__main__":
     try:
         main()
@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+"""
+Two-phase PubChem resolution (PUG REST, stdlib only):
+
+1) name -> CID, one small request per name (`/compound/name/cids/TXT`)
+2) CID -> SMILES for up to BULK_SIZE CIDs per request
+   (`/compound/cid/property/IsomericSMILES/JSON`)
+
+Compared with `pcp.get_compounds(name, 'name')`, which downloads the full
+compound record for every name, only CIDs and one property travel over the
+wire. Every request goes through the shared PUBCHEM_LIMITER and api_slot().
+
+The base URL can be pointed to a local stand-in with PUBCHEM_BASE_URL.
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from api_limits import PUBCHEM_LIMITER, api_slot
+from metrics import METRICS
+
+# PubChem paths of smiles_step (--pubchem-backend):
+# "compound": pcp.get_compounds per name (full record)
+# "batch": name -> CID then bulk CID -> SMILES (this module)
+PUBCHEM_BACKENDS = ("compound", "batch")
+
+DEFAULT_BASE_URL = "https://pubchem.ncbi.nlm.nih.gov/rest/pug"
+BULK_SIZE = 200
+MAX_RETRIES = 3
+TIMEOUT_S = 30
+NAME_WORKERS = 4
+
+
+def base_url() -> str:
+    return os.getenv("PUBCHEM_BASE_URL", DEFAULT_BASE_URL).rstrip("/")
+
+
+def _post(path: str, fields: Dict[str, str]) -> Optional[bytes]:
+    """
+    POST form fields to base_url()/path. Returns the body, or None on 404
+    (PubChem's answer for unknown names). Retries on 503 (server busy).
+    """
+    # imported here: pipeline.py only needs PUBCHEM_BACKENDS from this module
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    url = f"{base_url()}/{path}"
+    data = urllib.parse.urlencode(fields).encode("utf-8")
+    for attempt in range(MAX_RETRIES + 1):
+        PUBCHEM_LIMITER.wait()
+        METRICS.inc("pubchem_requests_total", endpoint=path.split("/")[-2])
+        try:
+            with api_slot():
+                with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=TIMEOUT_S) as resp:
+                    body = resp.read()
+            METRICS.inc("pubchem_bytes_total", len(body), backend="batch")
+            return body
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            if e.code in (429, 503) and attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt)
+                continue
+            raise
+    return None
+
+
+def name_to_cid(name: str) -> Optional[int]:
+    body = _post("compound/name/cids/TXT", {"name": name})
+    if not body:
+        return None
+    for line in body.decode("utf-8", "replace").split():
+        if line.strip().isdigit() and int(line) > 0:
+            return int(line)
+    return None
+
+
+def cids_to_smiles(cids: Iterable[int]) -> Dict[int, str]:
+    """Bulk CID -> isomeric SMILES, BULK_SIZE CIDs per request."""
+    unique = list(dict.fromkeys(int(c) for c in cids))
+    out: Dict[int, str] = {}
+    for i in range(0, len(unique), BULK_SIZE):
+        chunk = unique[i:i + BULK_SIZE]
+        body = _post("compound/cid/property/IsomericSMILES/JSON", {"cid": ",".join(map(str, chunk))})
+        if not body:
+            continue
+        props = json.loads(body).get("PropertyTable", {}).get("Properties", [])
+        for p in props:
+            # PubChem now answers IsomericSMILES requests with a "SMILES" key
+            smi = p.get("IsomericSMILES") or p.get("SMILES")
+            if smi:
+                out[int(p["CID"])] = str(smi).strip()
+    return out
+
+
+def resolve_name(name: str) -> str:
+    """
+    One name -> SMILES or 'Not Found' (unknown to PubChem). Transport and
+    HTTP errors propagate, so they are not mistaken for a missing compound.
+    """
+    cid = name_to_cid(name)
+    if not cid:
+        return "Not Found"
+    return cids_to_smiles([cid]).get(cid, "Not Found")
+
+
+def resolve_names(names: Iterable[str], workers: int = NAME_WORKERS) -> Dict[str, str]:
+    """
+    name -> SMILES or 'Not Found' (same contract as smiles_step.pubchem).
+    Names whose lookup hit a transport / HTTP error are left out of the
+    result: callers must not read their absence as 'Not Found', but look
+    them up again with resolve_name(), which raises the error.
+    """
+    unique: List[str] = list(dict.fromkeys(n for n in names if n and str(n).strip()))
+    if not unique:
+        return {}
+
+    t0 = time.perf_counter()
+    cid_of: Dict[str, Optional[int]] = {}
+
+    def lookup(name: str) -> None:
+        try:
+            cid_of[name] = name_to_cid(name)
+        except Exception:
+            METRICS.inc("pubchem_batch_errors_total", phase="name")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lookup, unique))
+
+    smiles_of = cids_to_smiles(c for c in cid_of.values() if c)
+
+    out: Dict[str, str] = {}
+    for name, cid in cid_of.items():
+        out[name] = smiles_of.get(cid, "Not Found") if cid else "Not Found"
+
+    METRICS.observe("pubchem_batch_seconds", time.perf_counter() - t0)
+    return out
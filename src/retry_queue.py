@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+"""
+Persistent queue of failed items (one JSON file per input, next to the outputs).
+
+Each entry records the stage ("extract": a procedure Index, "smiles": a
+compound name), the error class and message, and the attempt count. The
+`retry` command of pipeline.py re-runs only these items; an item that still
+fails after `max_attempts` is moved to the dead-letter file (JSON lines) so
+it is never retried again automatically.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from metrics import METRICS
+
+STAGES = ("extract", "smiles")
+
+
+class StepError(RuntimeError):
+    """A failure a step reported as a "<class>: <message>" string (e.g. a SMILES trace)."""
+
+
+def _item_id(stage: str, key: str) -> str:
+    return f"{stage}:{key}"
+
+
+class RetryQueue:
+    def __init__(self, path: str | Path, dead_letter_path: Optional[str | Path] = None):
+        self.path = Path(path)
+        if dead_letter_path is None:
+            dead_letter_path = self.path.with_name(self.path.stem.replace("_retry", "") + "_dead_letter.jsonl")
+        self.dead_letter_path = Path(dead_letter_path)
+        self._lock = threading.Lock()
+        self.outputs: Dict[str, str] = {}
+        self._items: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with self.path.open("r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.outputs = state.get("outputs", {})
+            self._items = {_item_id(it["stage"], it["key"]): it for it in state.get("items", [])}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _save(self) -> None:
+        # write-then-rename: a crash never leaves a truncated queue
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"outputs": self.outputs, "items": list(self._items.values())}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def set_outputs(self, paths: Dict[str, Path]) -> None:
+        """Remember the output files of the run, so `retry` patches the same ones."""
+        with self._lock:
+            self.outputs = {k: str(v) for k, v in paths.items()}
+            self._save()
+
+    def add(self, stage: str, key: str, error: BaseException | str, **context: Any) -> Dict[str, Any]:
+        """Record one failed attempt (creates the entry or bumps its attempt count)."""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown retry stage: {stage}")
+        if isinstance(error, StepError):
+            error = str(error)
+        if isinstance(error, BaseException):
+            error_class, message = type(error).__name__, str(error)
+        else:
+            error_class, _, message = str(error).partition(": ")
+            if not message:
+                error_class, message = "Error", str(error)
+        now = time.time()
+        with self._lock:
+            item = self._items.setdefault(
+                _item_id(stage, key),
+                {"stage": stage, "key": key, "attempts": 0, "first_failed": now},
+            )
+            item.update(context)
+            item.update({"error_class": error_class, "error": message, "last_failed": now})
+            item["attempts"] += 1
+            self._save()
+        METRICS.inc("retry_queue_added_total", stage=stage, error=error_class)
+        return dict(item)
+
+    def resolve(self, stage: str, key: str) -> bool:
+        """Drop an item that succeeded. Returns True if it was queued."""
+        with self._lock:
+            if self._items.pop(_item_id(stage, key), None) is None:
+                return False
+            self._save()
+        return True
+
+    def dead_letter(self, stage: str, key: str) -> None:
+        with self._lock:
+            item = self._items.pop(_item_id(stage, key), None)
+            if item is None:
+                return
+            item["dead_lettered"] = time.time()
+            self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.dead_letter_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self._save()
+        METRICS.inc("retry_queue_dead_lettered_total", stage=stage)
+
+    def items(self, stage: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(it) for it in self._items.values() if stage is None or it["stage"] == stage]
+
+
+def retry_items(
+    queue: RetryQueue,
+    items: Iterable[Dict[str, Any]],
+    fn: Callable[[Dict[str, Any]], Any],
+    max_attempts: int = 3,
+    backoff_s: float = 2.0,
+    workers: int = 4,
+) -> Dict[str, Any]:
+    """
+    Run fn(item) for every item, `workers` at a time. A failure is recorded
+    in the queue and retried after backoff_s * 2**n seconds until the item
+    has max_attempts attempts in total; it is then dead-lettered.
+    Returns {key: fn result} for the items that succeeded (and resolves them).
+    """
+    results: Dict[str, Any] = {}
+
+    def run(item: Dict[str, Any]) -> None:
+        stage, key = item["stage"], item["key"]
+        attempts = item["attempts"]
+        n = 0
+        while attempts < max_attempts:
+            if n:
+                time.sleep(backoff_s * 2 ** (n - 1))
+            n += 1
+            try:
+                res = fn(item)
+            except Exception as e:
+                attempts = queue.add(stage, key, e)["attempts"]
+                continue
+            results[key] = res
+            queue.resolve(stage, key)
+            METRICS.inc("retry_queue_recovered_total", stage=stage)
+            return
+        queue.dead_letter(stage, key)
+
+    items = list(items)
+    if items:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(run, items))
+    return results
@@ -3,11 +3,31 @@ import time
 import json
 import re
 import ast
+import copy
+import subprocess
+import tempfile
+import threading
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-import pubchempy as pcp
-from openai import OpenAI
+
+import pubchem_batch
+from pubchem_batch import PUBCHEM_BACKENDS
+from api_limits import PUBCHEM_LIMITER, api_slot
+from budget import BudgetExceeded
+from llm import chat_completion
+from metrics import METRICS, timed_stage
+
+_pubchem_backend = "compound"
+# name -> SMILES / 'Not Found' already fetched by the batch backend
+_pubchem_prefetch = {}
+_pubchem_prefetch_lock = threading.Lock()
+
+# Memo of resolved names shared by every table processed in this process.
+# Key: (name, model) -> trace dict (without Role)
+_smiles_memo = {}
+_smiles_memo_lock = threading.Lock()
 
 def smart_split_chem_list(text: str):
     """
@@ -113,11 +133,106 @@ def smart_split_chem_list(text: str):
     return out
 
 
-def pubchem(name):
+# variants of prime / quote / dash seen in extracted names
+_NAME_CHAR_MAP = str.maketrans({
+    "′": "'", "‵": "'", "’": "'", "‘": "'", "`": "'", "´": "'",
+    "″": "''", "‶": "''",
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-",
+})
+
+
+# letter/digit runs of a name; only ordinary words among them are case-folded
+_NAME_TOKEN = re.compile(r"[^\W_]+")
+
+# common solvent / reagent abbreviations, matched in any case ("THF" = "thf")
+_FOLDED_ABBREVIATIONS = frozenset({
+    "thf", "dmf", "dmso", "et2o", "dcm", "dce", "dme", "dma", "nmp", "hmpa",
+    "mecn", "meoh", "etoh", "etoac", "acoh", "ac2o", "tfa", "tea", "dipea",
+    "dmap", "dbu", "mtbe", "tbme", "ipa",
+})
+
+
+def _fold_token(m):
+    """
+    Case-fold an ordinary word: lower / Title case of 3+ letters, ALL CAPS of
+    4+ letters ("ETHYL ACETATE"), or a known abbreviation (THF, Et2O, ...).
+    Element symbols, D/L, R/S, N- locants and formulas keep their case:
+    CO / Co, HF / Hf, D- / d- are different species.
+    """
+    tok = m.group(0)
+    folded = tok.casefold()
+    if folded in _FOLDED_ABBREVIATIONS:
+        return folded
+    if tok.isalpha() and ((len(tok) >= 3 and tok[1:].islower()) or (len(tok) >= 4 and tok.isupper())):
+        return folded
+    return tok
+
+
+def normalize_name(name):
+    """
+    Lookup key of a compound name: NFKC, unified primes/dashes, collapsed
+    whitespace, ordinary words case-folded (see _fold_token). "Ethyl acetate",
+    " ETHYL  ACETATE" share one key, as do "Et2O" / "et2o" and 2,2′- / 2,2'-;
+    "CO" and "Co" do not.
+    """
+    if name is None:
+        return ""
+    s = unicodedata.normalize("NFKC", str(name)).translate(_NAME_CHAR_MAP)
+    s = re.sub(r"\s+", " ", s).strip()
+    return _NAME_TOKEN.sub(_fold_token, s)
+
+
+def set_pubchem_backend(backend):
+    global _pubchem_backend
+    if backend not in PUBCHEM_BACKENDS:
+        raise ValueError(f"Unknown PubChem backend: {backend} (expected one of {PUBCHEM_BACKENDS})")
+    _pubchem_backend = backend
+
+
+def prefetch_pubchem(names):
+    """
+    Batch backend only: resolve many names in two phases up front, so that
+    the per-name pubchem() calls below are answered from memory (names that
+    hit an error are left out and looked up again, errors raised, by pubchem()).
+    """
+    if _pubchem_backend != "batch":
+        return
+    with _pubchem_prefetch_lock:
+        todo = [n for n in dict.fromkeys(names) if n not in _pubchem_prefetch]
+    if not todo:
+        return
     try:
-        smi = pcp.get_compounds(name, 'name')[0].isomeric_smiles
+        found = pubchem_batch.resolve_names(todo)
     except Exception as e:
+        # pubchem() falls back to one request per name
+        print(f"[smiles_step] PubChem batch prefetch failed: {e}")
+        return
+    with _pubchem_prefetch_lock:
+        _pubchem_prefetch.update(found)
+
+
+def pubchem(name):
+    """
+    SMILES of a name, or 'Not Found' when PubChem has no match (empty result
+    or 404). Timeouts, 5xx / throttling and connection errors propagate, so
+    the trace records them and the name is retried instead of memoized.
+    """
+    with _pubchem_prefetch_lock:
+        hit = _pubchem_prefetch.get(name)
+    if hit is not None:
+        return hit
+    if _pubchem_backend == "batch":
+        return pubchem_batch.resolve_name(name)
+
+    import pubchempy as pcp  # only the "compound" backend needs it
+
+    PUBCHEM_LIMITER.wait()
+    try:
+        with api_slot():
+            compounds = pcp.get_compounds(name, 'name')
+    except pcp.NotFoundError:
         return 'Not Found'
+    smi = compounds[0].isomeric_smiles if compounds else None
     if smi and str(smi).strip():
         return str(smi).strip()
     return 'Not Found'
@@ -128,15 +243,17 @@ def opsin(name):
     if not os.path.exists(jar_path):
         return "Not Found"
 
-    with open('input_temp.txt', 'w') as f:
-        f.writelines([name])
-        f.close()
-    os.system(f'java -jar "{jar_path}" -osmi input_temp.txt output_temp.txt')
-    if not os.path.exists("output_temp.txt"):
-        return "Not Found"
-    with open('output_temp.txt', 'r') as f:
-        smi = f.readline()
-        f.close()
+    # per-call temp files: several tables may be resolved in parallel
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "input_temp.txt")
+        output_path = os.path.join(tmp, "output_temp.txt")
+        with open(input_path, 'w') as f:
+            f.writelines([name])
+        subprocess.run(["java", "-jar", jar_path, "-osmi", input_path, output_path])
+        if not os.path.exists(output_path):
+            return "Not Found"
+        with open(output_path, 'r') as f:
+            smi = f.readline()
     smi = smi.strip()
     if smi:
         return smi
@@ -160,17 +277,14 @@ def get_name_from_llama(name, model="gpt-4o-mini", ):
 
     """
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    response = client.chat.completions.create(
-       model=model,
-        messages=[
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt + name}
-    ],
-)
-
-    result = response.choices[0].message.content
+    result = chat_completion(
+        [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt + name}
+        ],
+        model=model,
+        stage="smiles",
+    )
 
     # 1) enlever les fences ```json ... ```
     clean = re.sub(r"^```(?:json)?\s*|\s*```$", "", result.strip())
@@ -193,22 +307,82 @@ def get_name_from_llama(name, model="gpt-4o-mini", ):
 
 
 
+TRACE_COLUMNS = [
+    "Original", "Candidate_used", "SMILES", "Status", "Route",
+    "PubChem_result", "OPSIN_result", "LLM_suggestions", "Notes",
+]
+
+
 def get_smiles_with_trace(name, model="gpt-4o-mini"):
-    trace = {
-        "Original": name,
-        "Candidate_used": "",
-        "SMILES": "",
-        "Status": "NOT_FOUND",
-        "Route": "",
-        "PubChem_result": "",
-        "OPSIN_result": "",
-        "LLM_suggestions": "",
-        "Notes": "",
-    }
+    """
+    Resolve a name to SMILES (PubChem -> OPSIN -> LLM suggestions).
+    Results are memoized per (normalize_name(name), model) for the whole
+    process; "Original" is always the name passed in.
+    """
+    key = (normalize_name(name), model)
+    with _smiles_memo_lock:
+        cached = _smiles_memo.get(key)
+    if cached is not None:
+        METRICS.inc("smiles_memo_hits_total")
+        trace = copy.deepcopy(cached)
+        trace["Original"] = name
+        return trace
+
+    trace = _resolve_smiles(name, model)
+
+    # a budget skip or a backend error is not a verdict on the name: allow a later retry
+    if trace["LLM_suggestions"] != "SKIPPED_BUDGET" and not trace_errors(trace):
+        with _smiles_memo_lock:
+            _smiles_memo[key] = copy.deepcopy(trace)
+    return trace
+
+
+def trace_errors(trace):
+    """Backend errors ("ERROR: <class>: <message>") of an unresolved trace."""
+    if trace.get("Status") == "OK":
+        return []
+    return [
+        str(trace[col])[len("ERROR: "):]
+        for col in ("PubChem_result", "OPSIN_result", "LLM_suggestions")
+        if str(trace.get(col, "")).startswith("ERROR: ")
+    ]
+
+
+def _memoized(name, model):
+    with _smiles_memo_lock:
+        return (normalize_name(name), model) in _smiles_memo
+
+
+def clear_smiles_memo():
+    with _smiles_memo_lock:
+        _smiles_memo.clear()
+
+
+def _call_backend(backend, fn, *args, **kwargs):
+    """
+    Call one resolution backend (pubchem / opsin / llm) and record its
+    latency and outcome (found / not_found / error).
+    """
+    t0 = time.perf_counter()
+    try:
+        res = fn(*args, **kwargs)
+    except Exception:
+        METRICS.observe("smiles_backend_latency_seconds", time.perf_counter() - t0, backend=backend)
+        METRICS.inc("smiles_backend_calls_total", backend=backend, result="error")
+        raise
+    found = bool(res) and res != "Not Found"
+    METRICS.observe("smiles_backend_latency_seconds", time.perf_counter() - t0, backend=backend)
+    METRICS.inc("smiles_backend_calls_total", backend=backend, result="found" if found else "not_found")
+    return res
+
+
+def _resolve_smiles(name, model="gpt-4o-mini"):
+    trace = dict.fromkeys(TRACE_COLUMNS, "")
+    trace.update({"Original": name, "Status": "NOT_FOUND"})
 
     # 1) PubChem sur original
     try:
-        smi = pubchem(name)
+        smi = _call_backend("pubchem", pubchem, name)
         if smi != "Not Found":
             trace.update({
                 "Candidate_used": name,
@@ -222,11 +396,11 @@ def get_smiles_with_trace(name, model="gpt-4o-mini"):
             return trace
         trace["PubChem_result"] = "NOT_FOUND"
     except Exception as e:
-        trace["PubChem_result"] = f"ERROR: {e}"
+        trace["PubChem_result"] = f"ERROR: {type(e).__name__}: {e}"
 
     # 2) OPSIN sur original
     try:
-        smi = opsin(name)
+        smi = _call_backend("opsin", opsin, name)
         if smi != "Not Found":
             trace.update({
                 "Candidate_used": name,
@@ -239,15 +413,19 @@ def get_smiles_with_trace(name, model="gpt-4o-mini"):
             return trace
         trace["OPSIN_result"] = "NOT_FOUND"
     except Exception as e:
-        trace["OPSIN_result"] = f"ERROR: {e}"
+        trace["OPSIN_result"] = f"ERROR: {type(e).__name__}: {e}"
 
     # 3) LLM: proposer un ou plusieurs noms alternatifs
     suggestions = []
     try:
-        suggestions = get_name_from_llama(name, model=model)  # doit renvoyer une LISTE
+        suggestions = _call_backend("llm", get_name_from_llama, name, model=model)  # doit renvoyer une LISTE
         trace["LLM_suggestions"] = json.dumps(list(suggestions), ensure_ascii=False)
+    except BudgetExceeded:
+        # budget tight: keep it for extraction, skip the LLM tier
+        trace["LLM_suggestions"] = "SKIPPED_BUDGET"
+        suggestions = []
     except Exception as e:
-        trace["LLM_suggestions"] = f"ERROR: {e}"
+        trace["LLM_suggestions"] = f"ERROR: {type(e).__name__}: {e}"
         suggestions = []
 
     # 4) Tester PubChem/OPSIN sur suggestions (dans l’ordre)
@@ -258,7 +436,7 @@ def get_smiles_with_trace(name, model="gpt-4o-mini"):
 
         # PubChem cand
         try:
-            smi = pubchem(cand)
+            smi = _call_backend("pubchem", pubchem, cand)
             if smi != "Not Found":
                 trace.update({
     "Candidate_used": cand,
@@ -273,7 +451,7 @@ def get_smiles_with_trace(name, model="gpt-4o-mini"):
 
         # OPSIN cand
         try:
-            smi = opsin(cand)
+            smi = _call_backend("opsin", opsin, cand)
             if smi != "Not Found":
                 trace.update({
     "Candidate_used": cand,
@@ -294,18 +472,11 @@ def get_smiles_with_trace(name, model="gpt-4o-mini"):
         trace["Notes"] = "Likely polymer/mixture; SMILES may be undefined."
     return trace
 
-def run_smiles_lookup(
-    input_table_csv,
-    output_smiles_csv,
-    model="gpt-4o-mini"
-):
+def table_names(input_data):
     """
-    Pipeline step 4:
-    Read *_table.csv and generate smiles_lookup.csv
+    Compound names of a *_table.csv frame: one row per (normalized name, role),
+    columns Name / Role / Key. The first spelling seen is kept as Name.
     """
-
-    input_data = pd.read_csv(input_table_csv)
-
     def explode_column(df, col, role):
         series = df[col].fillna("").astype(str)
         items = []
@@ -325,21 +496,172 @@ def run_smiles_lookup(
     react = explode_column(input_data, "Reactants", "Reactant")
     prod  = explode_column(input_data, "Products",  "Product")
 
-    names_df = pd.concat([react, prod], ignore_index=True) \
-                 .drop_duplicates(subset=["Name", "Role"])
+    names_df = pd.concat([react, prod], ignore_index=True)
+    names_df["Key"] = names_df["Name"].map(normalize_name)
+    return names_df.drop_duplicates(subset=["Key", "Role"])
 
+
+def _resolve_keys(names_df, model, retry_queue=None):
+    """Resolve each normalized name once, whatever its role(s). Returns {Key: trace}."""
+    unique = names_df.drop_duplicates(subset=["Key"])
+    prefetch_pubchem([n for n in unique["Name"] if not _memoized(n, model)])
+    resolved = {}
+    for key, name in unique[["Key", "Name"]].itertuples(index=False):
+        trace = get_smiles_with_trace(name, model=model)
+        resolved[key] = trace
+        if retry_queue is None:
+            continue
+        errors = trace_errors(trace)
+        if errors:
+            retry_queue.add("smiles", name, errors[0])
+        else:
+            retry_queue.resolve("smiles", name)
+    return resolved
+
+
+def _lookup_rows(names_df, resolved):
     rows = []
     for _, r in names_df.iterrows():
-        t = get_smiles_with_trace(r["Name"], model=model)
+        t = copy.deepcopy(resolved[r["Key"]])
+        t["Original"] = r["Name"]
         t["Role"] = r["Role"]
         rows.append(t)
+    # explicit columns so an empty lookup (e.g. extraction skipped by the budget) stays readable
+    return pd.DataFrame(rows, columns=TRACE_COLUMNS + ["Role"])
+
 
-    output_data = pd.DataFrame(rows)
+# background lookups per NamePrefetcher
+PREFETCH_WORKERS = 2
+# batch backend: names arriving within this window share one bulk PubChem lookup
+PREFETCH_WINDOW_S = 0.25
+
+
+class NamePrefetcher:
+    """
+    Resolves the names of table rows in the background while they are still
+    being extracted (rows as produced by extract_step.TableRowParser). It only
+    fills the SMILES memo: step 4 then answers those names from memory, and
+    re-resolves (and queues) the ones that hit an error here.
+    With the batch PubChem backend, names are gathered for PREFETCH_WINDOW_S
+    and sent through prefetch_pubchem() together (bulk CID -> SMILES) before
+    their per-name resolution.
+    """
+
+    def __init__(self, model="gpt-4o-mini", workers=PREFETCH_WORKERS, window_s=PREFETCH_WINDOW_S):
+        self.model = model
+        self.window_s = window_s
+        self._seen = set()
+        self._pending = []
+        self._timers = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="smiles-prefetch")
+        self._closed = False
+
+    def add_row(self, row):
+        """row: [Index, Reactants, Reactant amounts, Products, ...]"""
+        names = table_names(pd.DataFrame({"Reactants": [row[1]], "Products": [row[3]]}))
+        with self._lock:
+            if self._closed:
+                return
+            new = []
+            for key, name in names[["Key", "Name"]].itertuples(index=False):
+                if key not in self._seen:
+                    self._seen.add(key)
+                    new.append(name)
+            if _pubchem_backend != "batch":
+                for name in new:
+                    self._pool.submit(self._resolve, name)
+                return
+            if new and not self._pending:
+                timer = threading.Timer(self.window_s, self._flush)
+                timer.daemon = True
+                timer.start()
+                self._timers.append(timer)
+            self._pending.extend(new)
+
+    def _flush(self):
+        """Bulk PubChem lookup of the gathered names, then resolve each one."""
+        with self._lock:
+            names, self._pending = self._pending, []
+        if not names:
+            return
+        prefetch_pubchem(names)
+        for name in names:
+            self._pool.submit(self._resolve, name)
+
+    def _resolve(self, name):
+        try:
+            get_smiles_with_trace(name, model=self.model)
+            METRICS.inc("smiles_prefetched_total")
+        except Exception as e:
+            METRICS.inc("smiles_prefetch_errors_total", error=type(e).__name__)
+
+    def close(self):
+        """Resolve the names still gathered and wait for all of them (idempotent)."""
+        with self._lock:
+            self._closed = True
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer.cancel()
+            timer.join()
+        self._flush()
+        self._pool.shutdown(wait=True)
+
+
+@timed_stage("smiles")
+def run_smiles_lookup(
+    input_table_csv,
+    output_smiles_csv,
+    model="gpt-4o-mini",
+    retry_queue=None,
+):
+    """
+    Pipeline step 4:
+    Read *_table.csv and generate smiles_lookup.csv
+    Names whose lookup hit a backend error are recorded in `retry_queue`.
+    """
+
+    input_data = pd.read_csv(input_table_csv)
+    names_df = table_names(input_data)
+    resolved = _resolve_keys(names_df, model, retry_queue)
+
+    output_data = _lookup_rows(names_df, resolved)
     output_data.to_csv(output_smiles_csv, index=False)
 
     return output_smiles_csv
 
 
+@timed_stage("smiles")
+def patch_smiles_lookup(
+    input_table_csv,
+    smiles_csv,
+    model="gpt-4o-mini",
+    traces=None,
+    retry_queue=None,
+):
+    """
+    Rebuild smiles_lookup.csv for the current table without resolving the
+    names it already has: existing traces are reused, `traces` ({name: trace},
+    e.g. retried lookups) replace theirs, only names new to the lookup are
+    resolved, and names no longer in the table are dropped.
+    Returns the number of names looked up or replaced.
+    """
+    lookup = pd.read_csv(smiles_csv, dtype=str, keep_default_na=False)
+    known = {}
+    for t in lookup[TRACE_COLUMNS].to_dict("records"):
+        known.setdefault(normalize_name(t["Original"]), t)
+    updated = {normalize_name(n): t for n, t in (traces or {}).items()}
+    known.update(updated)
+
+    names_df = table_names(pd.read_csv(input_table_csv))
+    missing = names_df[~names_df["Key"].isin(known)]
+    if len(missing):
+        known.update(_resolve_keys(missing, model, retry_queue))
+
+    _lookup_rows(names_df, known).to_csv(smiles_csv, index=False)
+    return len(updated) + missing["Key"].nunique()
+
+
 if __name__ == '__main__':
 
     start = time.perf_counter()
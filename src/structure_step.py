@@ -3,6 +3,8 @@
 import pandas as pd
 import time
 
+from metrics import timed_stage
+
 
 
 def tabulate_condition(df):
@@ -33,6 +35,29 @@ def main(volumes):
         df2 = tabulate_condition(df)
         df2.to_csv(filename + '_table.csv', index=None)
 
+def procedure_of(table_index):
+    '''
+    procedure Index of table rows (pbfa_1 from pbfa_1_2).
+    '''
+    return table_index.astype(str).str.rsplit("_", n=1).str[0]
+
+@timed_stage("structure")
+def patch_table(summary_df, table_csv, order, drop=()):
+    '''
+    Update an existing *_table.csv: the rows of the procedures in summary_df
+    (Index, Summary) or in `drop` are removed, summary_df is tabulated and
+    inserted, and rows follow `order` ({procedure Index: position}).
+    '''
+    old = pd.read_csv(table_csv, dtype=str, keep_default_na=False)
+    gone = set(drop) | set(summary_df['Index'].astype(str))
+    kept = old[~procedure_of(old['Index']).isin(gone)]
+    new = tabulate_condition(summary_df)
+    out = pd.concat([kept, new], ignore_index=True)
+    out = out.sort_values('Index', key=lambda s: procedure_of(s).map(order), kind='stable')
+    out.to_csv(table_csv, index=False)
+    return len(new)
+
+@timed_stage("structure")
 def run_structure(input_summary_csv, output_table_csv):
     """
     Pipeline step 2:
@@ -1,24 +1,18 @@
 # -*- coding: UTF-8 -*-
-from openai import OpenAI
-import os
 import time
-import json
 import pandas as pd
 
+from budget import BudgetExceeded
+from llm import chat_completion
+from metrics import timed_stage
+
 
 def get_completion(prompt, model='gpt-4o-mini'):
     '''
         get completion from OpenAI.
     '''
     messages = [{'role': 'user', "content": prompt}]
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    response = client.chat.completions.create(
-    model=model,
-    messages=messages,
-    temperature=0
-)
-
-    return response.choices[0].message.content
+    return chat_completion(messages, model=model, temperature=0, stage="time")
 
 def get_times(text, model):
     '''
@@ -112,6 +106,7 @@ def main(volumes, delay=20, model="gpt-4o-mini"):
         df2.to_csv(filename + '_timetable.csv', index=None)
 
 
+@timed_stage("time")
 def run_time_standardize(
     input_table_csv,
     output_timetable_csv,
@@ -128,13 +123,53 @@ def run_time_standardize(
     if delay and delay > 0:
         time.sleep(delay)
 
-    df2 = get_time_from_df(df, model)
+    try:
+        if len(df) == 0:
+            df2 = pd.DataFrame(columns=['Index', 'Reaction time'])
+        else:
+            df2 = get_time_from_df(df, model)
+    except BudgetExceeded as e:
+        # keep the pipeline going: times stay un-normalized
+        print(f"[time_step] budget reached, reaction times left as N/A: {e}")
+        df2 = pd.DataFrame({'Index': df['Index'], 'Reaction time': 'N/A'})
     df2.to_csv(output_timetable_csv, index=False)
 
     return output_timetable_csv
 
 
 
+@timed_stage("time")
+def patch_timetable(
+    input_table_csv,
+    timetable_csv,
+    model="gpt-4o-mini",
+    refresh=(),
+):
+    """
+    Update an existing *_timetable.csv: standardize only the table rows that
+    have no time yet (or whose Index is in `refresh`), drop rows that left
+    the table, keep the table order. Returns the number of rows standardized.
+    """
+    df = pd.read_csv(input_table_csv)
+    old = pd.read_csv(timetable_csv, dtype=str, keep_default_na=False)
+    refresh = set(refresh)
+
+    todo = df[~df['Index'].isin(set(old['Index']) - refresh)].reset_index(drop=True)
+    new = pd.DataFrame(columns=['Index', 'Reaction time'])
+    if len(todo):
+        try:
+            new = get_time_from_df(todo, model)
+        except BudgetExceeded as e:
+            print(f"[time_step] budget reached, reaction times left as N/A: {e}")
+            new = pd.DataFrame({'Index': todo['Index'], 'Reaction time': 'N/A'})
+
+    kept = old[old['Index'].isin(set(df['Index']) - set(todo['Index']))]
+    out = pd.concat([kept, new], ignore_index=True)
+    order = {idx: i for i, idx in enumerate(df['Index'])}
+    out = out.sort_values('Index', key=lambda s: s.map(order), kind='stable')
+    out.to_csv(timetable_csv, index=False)
+    return len(todo)
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,324 @@
+# -*- coding: UTF-8 -*-
+"""
+SQLite-backed work queue for running the extract step on several processes
+or machines against one corpus.
+
+- seed()    : insert every procedure of an input JSON (idempotent)
+- claim()   : lease up to n pending (or lease-expired) procedures
+- renew()   : extend the leases a worker still holds (heartbeat)
+- complete(): store the LLM summary for a leased procedure
+- fail()    : release it for another attempt, or mark it failed
+- export_summary(): write the usual *_summary.csv of one input for the reducer
+- unfinished(): failed / pending items (the reducer queues them for `retry`)
+
+Items are keyed by (input, idx): several input files can share one queue
+even when their reaction keys overlap. Workers never hold a database lock
+during an LLM call, so throughput grows with the number of workers until
+the API (or the budget) is the bottleneck.
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    input         TEXT NOT NULL,      -- input JSON stem (see input_name())
+    idx           TEXT NOT NULL,      -- <reaction_key>_<procedure_index>
+    seq           INTEGER NOT NULL,   -- position in the input JSON
+    title         TEXT,
+    procedure     TEXT,
+    status        TEXT NOT NULL DEFAULT 'pending',  -- pending | leased | done | failed
+    owner         TEXT,
+    lease_expires REAL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    summary       TEXT,
+    error         TEXT,
+    updated       REAL,
+    PRIMARY KEY (input, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, input, seq);
+"""
+
+
+# wait between claims while other workers still hold live leases
+POLL_S = 0.5
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def input_name(input_json_path: str | Path) -> str:
+    """Queue key of an input file: its stem, like the output file names."""
+    return Path(input_json_path).stem
+
+
+class WorkQueue:
+    def __init__(self, path: str | Path, timeout_s: float = 60.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # autocommit mode; transactions are opened explicitly
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout_s, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = {r[1] for r in self.conn.execute("PRAGMA table_info(items)")}
+        if columns and "input" not in columns:
+            self.conn.close()
+            raise RuntimeError(
+                f"{self.path} was created by an older version (items not keyed by input); "
+                "drain it with that version or start a new queue file."
+            )
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "WorkQueue":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def seed(self, input_json_path: str | Path) -> int:
+        """Add every procedure of the input JSON; existing keys are left untouched."""
+        from extract_step import iter_procedures
+
+        with Path(input_json_path).open("r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        name = input_name(input_json_path)
+        items = [
+            (name, idx, seq, title, proc)
+            for seq, (idx, title, proc) in enumerate(iter_procedures(data))
+        ]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO items (input, idx, seq, title, procedure) VALUES (?, ?, ?, ?, ?)",
+                items,
+            )
+            added = self.conn.total_changes - before
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(
+        self, owner: str, n: int = 1, lease_s: float = 600.0, max_attempts: int = 3
+    ) -> List[Tuple[str, str, str, str]]:
+        """
+        Lease up to n procedures (pending, or leased with an expired lease).
+        An expired lease that already used max_attempts (e.g. a procedure that
+        kills its worker) is marked failed instead of being leased again.
+        Returns [(input, idx, title, procedure)].
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                """
+                UPDATE items
+                SET status = 'failed', lease_expires = NULL, updated = ?,
+                    error = COALESCE(error, 'Lease expired (worker lost)')
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?
+                """,
+                (now, now, max_attempts),
+            )
+            rows = self.conn.execute(
+                """
+                SELECT input, idx, title, procedure FROM items
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY input, seq LIMIT ?
+                """,
+                (now, n),
+            ).fetchall()
+            self.conn.executemany(
+                """
+                UPDATE items SET status = 'leased', owner = ?, lease_expires = ?,
+                       attempts = attempts + 1, updated = ?
+                WHERE input = ? AND idx = ?
+                """,
+                [(owner, now + lease_s, now, r[0], r[1]) for r in rows],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [tuple(r) for r in rows]
+
+    def renew(self, owner: str, keys: List[Tuple[str, str]], lease_s: float = 600.0) -> int:
+        """Extend the leases `owner` still holds on [(input, idx)]. Returns how many."""
+        now = time.time()
+        cur = self.conn.executemany(
+            """
+            UPDATE items SET lease_expires = ?, updated = ?
+            WHERE input = ? AND idx = ? AND owner = ? AND status = 'leased'
+            """,
+            [(now + lease_s, now, name, idx, owner) for name, idx in keys],
+        )
+        return cur.rowcount
+
+    def complete(self, name: str, idx: str, owner: str, summary: str) -> bool:
+        """
+        Store a result. Ignored (returns False) if the lease was lost and the
+        item was already completed by another worker.
+        """
+        cur = self.conn.execute(
+            """
+            UPDATE items SET status = 'done', summary = ?, error = NULL, owner = ?, updated = ?
+            WHERE input = ? AND idx = ? AND status != 'done'
+            """,
+            (summary, owner, time.time(), name, idx),
+        )
+        return cur.rowcount > 0
+
+    def fail(self, name: str, idx: str, owner: str, error: str, max_attempts: int = 3) -> None:
+        """Release the item for a later attempt, or mark it failed after max_attempts."""
+        self.conn.execute(
+            """
+            UPDATE items
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                error = ?, lease_expires = NULL, updated = ?
+            WHERE input = ? AND idx = ? AND owner = ? AND status = 'leased'
+            """,
+            (max_attempts, error, time.time(), name, idx, owner),
+        )
+
+    def counts(self, name: Optional[str] = None) -> Dict[str, int]:
+        """Items per status, for one input (input_name()) or the whole queue."""
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) FROM items WHERE ? IS NULL OR input = ? GROUP BY status",
+            (name, name),
+        ).fetchall()
+        out = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        out.update({status: n for status, n in rows})
+        return out
+
+    def has_live_leases(self) -> bool:
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM items WHERE status = 'leased' AND lease_expires >= ?",
+            (time.time(),),
+        ).fetchone()
+        return row[0] > 0
+
+    def unfinished(self, name: str) -> List[Tuple[str, str, Optional[str]]]:
+        """[(idx, status, last error)] of one input's items that are not done, in input order."""
+        return self.conn.execute(
+            "SELECT idx, status, error FROM items WHERE input = ? AND status != 'done' ORDER BY seq",
+            (name,),
+        ).fetchall()
+
+    def export_summary(
+        self, name: str, output_summary_csv_path: str | Path, error_txt_path: Optional[str | Path] = None
+    ) -> Path:
+        """
+        Write one input's done items as *_summary.csv (Index, Summary) in input
+        order, and its failed / unfinished ones to error_txt_path when given
+        (see unfinished()).
+        """
+        import pandas as pd
+
+        output_summary_csv_path = Path(output_summary_csv_path)
+        output_summary_csv_path.parent.mkdir(parents=True, exist_ok=True)
+        rows = self.conn.execute(
+            "SELECT idx, summary FROM items WHERE input = ? AND status = 'done' ORDER BY seq",
+            (name,),
+        ).fetchall()
+        pd.DataFrame(rows, columns=["Index", "Summary"]).to_csv(output_summary_csv_path, index=False)
+
+        if error_txt_path is not None:
+            with Path(error_txt_path).open("w", encoding="utf-8") as f:
+                f.writelines(f"{idx}: [{status}] {error or ''}\n" for idx, status, error in self.unfinished(name))
+        return output_summary_csv_path
+
+
+class _LeaseKeeper:
+    """
+    Renews a worker's current leases every lease_s / 3 from a thread with its
+    own connection, so a batch slower than the lease is not handed to
+    another worker meanwhile.
+    """
+
+    def __init__(self, queue_path: str | Path, owner: str, lease_s: float):
+        self.queue_path, self.owner, self.lease_s = queue_path, owner, lease_s
+        self._keys: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def hold(self, keys: List[Tuple[str, str]]) -> None:
+        with self._lock:
+            self._keys = list(keys)
+
+    def release(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._keys = [k for k in self._keys if k != key]
+
+    def _run(self) -> None:
+        with WorkQueue(self.queue_path) as q:
+            while not self._stop.wait(self.lease_s / 3):
+                with self._lock:
+                    keys = list(self._keys)
+                if keys:
+                    q.renew(self.owner, keys, self.lease_s)
+
+    def __enter__(self) -> "_LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    queue_path: str | Path,
+    model: str = "gpt-4o-mini",
+    fast_model: Optional[str] = None,
+    batch_size: int = 4,
+    lease_s: float = 600.0,
+    max_attempts: int = 3,
+    sleep_s: float = 0.0,
+    owner: Optional[str] = None,
+) -> Dict[str, int]:
+    """
+    Claim / extract / commit until the queue is drained. Leases are renewed
+    while the batch is processed. When only other workers' live leases
+    remain, wait: they are either finished or reclaimed once expired.
+    Returns {"done": n, "failed": n} for this worker.
+    """
+    from extract_step import extract_one
+
+    owner = owner or default_owner()
+    stats = {"done": 0, "failed": 0}
+    with WorkQueue(queue_path) as q, _LeaseKeeper(queue_path, owner, lease_s) as leases:
+        while True:
+            batch = q.claim(owner, n=batch_size, lease_s=lease_s, max_attempts=max_attempts)
+            if not batch:
+                if not q.has_live_leases():
+                    break
+                time.sleep(min(POLL_S, lease_s / 4))
+                continue
+            leases.hold([(name, idx) for name, idx, _, _ in batch])
+            for name, idx, title, proc in batch:
+                if sleep_s and sleep_s > 0:
+                    time.sleep(sleep_s)
+                try:
+                    summary = extract_one(title, proc, model=model, fast_model=fast_model)
+                except Exception as e:
+                    leases.release((name, idx))
+                    q.fail(name, idx, owner, f"{type(e).__name__}: {e}", max_attempts=max_attempts)
+                    stats["failed"] += 1
+                    continue
+                leases.release((name, idx))
+                q.complete(name, idx, owner, summary)
+                stats["done"] += 1
+    return stats
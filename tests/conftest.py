@@ -0,0 +1,6 @@
+# -*- coding: UTF-8 -*-
+# the pipeline modules live flat in src/ and import each other by bare name
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+import pytest
+
+from smiles_step import normalize_name
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Et2O", "et2o"),
+    ("Et2O", "ET2O"),
+    ("THF", "thf"),
+    ("DMSO", "dmso"),
+    ("ETHYL ACETATE", "ethyl acetate"),
+    ("Ethyl acetate", " ethyl  acetate "),
+    ("Benzaldehyde", "benzaldehyde"),
+    ("2,2′-bipyridine", "2,2'-Bipyridine"),
+])
+def test_same_compound_same_key(a, b):
+    assert normalize_name(a) == normalize_name(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("CO", "Co"),
+    ("NO", "No"),
+    ("HF", "Hf"),
+    ("CS", "Cs"),
+    ("COCl2", "CoCl2"),
+    ("D-glucose", "d-glucose"),
+    ("L-proline", "l-proline"),
+    ("N-methylaniline", "n-methylaniline"),
+    ("(R)-BINAP", "(r)-BINAP"),
+])
+def test_different_species_different_keys(a, b):
+    assert normalize_name(a) != normalize_name(b)
+
+
+def test_empty():
+    assert normalize_name(None) == ""
+    assert normalize_name("  ") == ""
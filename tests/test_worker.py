@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+
+
+def _free_port_pair() -> int:
+    """A port P with P and P + 1 free."""
+    for _ in range(50):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        try:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", port + 1))
+            return port
+        except OSError:
+            continue
+    raise RuntimeError("no free port pair")
+
+
+def test_worker_processes_with_metrics_port(tmp_path):
+    # empty input: the workers start (metrics endpoint included) and drain at once
+    input_json = tmp_path / "empty.json"
+    input_json.write_text(json.dumps({}), encoding="utf-8")
+    queue = tmp_path / "queue.sqlite"
+    port = _free_port_pair()
+
+    proc = subprocess.run(
+        [sys.executable, str(SRC / "pipeline.py"), "worker", str(input_json),
+         "--queue", str(queue), "--processes", "2", "--metrics-port", str(port)],
+        capture_output=True, text=True, timeout=120,
+        env=dict(os.environ, OPENAI_API_KEY="test"),
+    )
+    out = proc.stdout + proc.stderr
+    assert proc.returncode == 0, out
+    assert "Address already in use" not in out
+    assert f":{port}/metrics" in out and f":{port + 1}/metrics" in out
+    # every worker got past startup and wrote its report
+    assert len(list(tmp_path.glob("queue_worker_*_metrics.json"))) == 2